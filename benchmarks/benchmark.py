@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+
+import aiohttp
+import tiktoken
+from openai import AsyncOpenAI
+
+from async_utils import process_batch_data
+from async_utils import BasicTaskDatum, DeepInfraQuotaManager, HTTPClient, MetricsCollector, CallbackMetricsSink
+from async_utils import EmbeddingPacker
+from async_utils import OpenAITaskDatum, OpenAIQuotaManager, OpenAIAdaptiveQuotaManager, openai_task_runner
+from async_utils import OpenAIEmbTaskDatum, openai_emb_task_runner
+from async_utils import DeepInfraTaskDatum, deepinfra_task_runner
+from async_utils import DeepInfraEmbTaskDatum, deepinfra_emb_task_runner
+from async_utils import FedGPTTaskDatum, FedGPTQuotaManager, fedgpt_task_runner
+
+from mock_server import MockServer, start_server_process
+
+logger = logging.getLogger(__name__)
+
+# scenario -> (task datum class, task runner, input kind)
+SCENARIO_TO_SETTING = {
+    "basic": (BasicTaskDatum, None, "basic"),
+    "openai": (OpenAITaskDatum, openai_task_runner, "chat"),
+    "openai_adaptive": (OpenAITaskDatum, openai_task_runner, "chat"),
+    "openai_emb": (OpenAIEmbTaskDatum, openai_emb_task_runner, "emb"),
+    "deepinfra": (DeepInfraTaskDatum, deepinfra_task_runner, "chat"),
+    "deepinfra_emb": (DeepInfraEmbTaskDatum, deepinfra_emb_task_runner, "emb"),
+    "fedgpt": (FedGPTTaskDatum, fedgpt_task_runner, "chat"),
+}
+
+# results compared against a baseline run: name -> whether higher is better
+COMPARED_RESULT_TO_HIGHER_IS_BETTER = {
+    "tasks_per_second": True,
+    "cpu_per_task_us": False,
+}
+
+
+def get_tokenizer(name):
+    if name == "bytes":
+        # one token per byte, built locally for hosts that cannot download tiktoken encodings
+        return tiktoken.Encoding(
+            "bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={},
+        )
+    return tiktoken.get_encoding(name)
+
+
+def write_input_file(input_file, input_kind, tasks, arg):
+    with open(input_file, "w", encoding="utf8") as f:
+        for i in range(tasks):
+            if input_kind == "chat":
+                datum = {
+                    "text_in": f"Reverse the word order of the sentence: I have {i + 1} fish.",
+                    "model": "mock",
+                    "choices": 1,
+                    "max_tokens": arg.out_tokens,
+                }
+            elif input_kind == "emb":
+                datum = {
+                    "text_list": [f"embed text {j + 1} of row {i + 1}" for j in range(arg.texts_per_row)],
+                    "model": "mock",
+                    "dimension": arg.dimension,
+                }
+            else:
+                datum = {"i": i + 1}
+            json.dump(datum, f)
+            f.write("\n")
+    return
+
+
+def get_quota_manager(scenario, concurrency, arg):
+    # request-window managers send a burst of up to rpm requests, then wait for the minute to pass
+    # so concurrency bounds the tasks of a run, and rpm leaves room for retries within the minute
+    if scenario == "openai":
+        return OpenAIQuotaManager(arg.rpm or 2 * concurrency, arg.tpm or concurrency * 10000)
+    if scenario == "openai_adaptive":
+        return OpenAIAdaptiveQuotaManager(arg.rpm or 2 * concurrency, arg.tpm or concurrency * 10000)
+    if scenario == "fedgpt":
+        return FedGPTQuotaManager(concurrency)
+    return DeepInfraQuotaManager(concurrency)
+
+
+async def probe_loop_lag(lag_list, interval=0.01):
+    # how late the event loop wakes up a timer, i.e. how long the loop is busy between polls
+    while True:
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag_list.append(time.perf_counter() - start_time - interval)
+
+
+def get_percentile(value_list, percentile):
+    if not value_list:
+        return 0
+    value_list = sorted(value_list)
+    return value_list[min(len(value_list) - 1, int(len(value_list) * percentile / 100))]
+
+
+async def run_scenario(scenario, concurrency, tasks, arg, work_dir):
+    task_datum_class, task_runner, input_kind = SCENARIO_TO_SETTING[scenario]
+    server_url = f"http://{arg.host}:{arg.port}"
+    input_file = os.path.join(work_dir, f"{scenario}_{concurrency}_in.jsonl")
+    output_file = os.path.join(work_dir, f"{scenario}_{concurrency}_out.jsonl")
+    write_input_file(input_file, input_kind, tasks, arg)
+
+    # client
+    client = None
+    if scenario == "basic":
+        # no HTTP: the scheduler alone, with runs that sleep for the mock latency
+        latency_server = MockServer(latency=arg.latency, latency_distribution=arg.latency_distribution)
+
+        async def task_runner(task_datum):
+            task_datum.start_time = time.time()
+            await asyncio.sleep(latency_server.get_latency())
+            task_datum.end_time = time.time()
+            return task_datum
+    elif scenario == "fedgpt":
+        task_datum_class.api_url = f"{server_url}/fedgpt"
+        task_datum_class.http_client = HTTPClient(limit=arg.connections)
+    else:
+        base_url = f"{server_url}/v1/openai" if scenario.startswith("deepinfra") else f"{server_url}/v1"
+        client = AsyncOpenAI(api_key="mock", base_url=base_url, max_retries=0, timeout=600)
+        task_datum_class.client = client
+    if task_datum_class in (OpenAITaskDatum, OpenAIEmbTaskDatum):
+        task_datum_class.tokenizer = get_tokenizer(arg.tokenizer)
+    quota_manager = get_quota_manager(scenario, concurrency, arg)
+    packer = EmbeddingPacker() if arg.packer and input_kind == "emb" else None
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{server_url}/reset") as response:
+            await response.json()
+
+    snapshot_list = []
+    metrics = MetricsCollector([CallbackMetricsSink(snapshot_list.append)], interval=0.1)
+    lag_list = []
+    lag_task = asyncio.create_task(probe_loop_lag(lag_list))
+
+    start_cpu = time.process_time()
+    start_time = time.time()
+    try:
+        await process_batch_data(
+            input_file, output_file, task_datum_class, task_runner, quota_manager,
+            max_task_runs=arg.max_task_runs, ignore_and_rewrite_output_file=True,
+            packer=packer, metrics=metrics, task_log_every=0,
+        )
+    finally:
+        wall = time.time() - start_time
+        cpu = time.process_time() - start_cpu
+        lag_task.cancel()
+        if client is not None:
+            await client.close()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{server_url}/stats") as response:
+            server_stats = await response.json()
+
+    # mean utilization of the busiest quota over the periodic snapshots, the last one is taken after the job
+    utilization_list = [
+        max((quota["utilization"] for quota in snapshot["quota"].values()), default=0)
+        for snapshot in snapshot_list[:-1]
+    ]
+    final_snapshot = snapshot_list[-1]
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "tasks": tasks,
+        "done": final_snapshot["done"],
+        "failed": final_snapshot["failed"],
+        "wall": wall,
+        "tasks_per_second": tasks / wall,
+        "cpu": cpu,
+        "cpu_per_task_us": cpu / tasks * 1e6,
+        "loop_lag_p50_ms": get_percentile(lag_list, 50) * 1e3,
+        "loop_lag_p99_ms": get_percentile(lag_list, 99) * 1e3,
+        "loop_lag_max_ms": max(lag_list, default=0) * 1e3,
+        "quota_utilization": sum(utilization_list) / len(utilization_list) if utilization_list else 0,
+        "peak_in_flight": max(snapshot["in_flight"] for snapshot in snapshot_list),
+        "latency_p50": final_snapshot["latency"]["p50"],
+        "latency_p99": final_snapshot["latency"]["p99"],
+        "server_requests": server_stats["requests"],
+        "server_rate_limited": server_stats["rate_limited"],
+        "server_errors": server_stats["errors"],
+    }
+
+
+def get_result_string(result):
+    return (
+        f"[{result['scenario']}] concurrency {result['concurrency']:,}, {result['tasks']:,} tasks:"
+        f" {result['done']:,} done, {result['failed']:,} failed,"
+        f" {result['tasks_per_second']:,.0f} tasks/s, {result['cpu_per_task_us']:.0f}us cpu/task,"
+        f" loop lag p50 {result['loop_lag_p50_ms']:.1f}ms p99 {result['loop_lag_p99_ms']:.1f}ms"
+        f" max {result['loop_lag_max_ms']:.1f}ms,"
+        f" quota {result['quota_utilization']:.0%}, peak in flight {result['peak_in_flight']:,},"
+        f" server {result['server_requests']:,} requests {result['server_rate_limited']:,} 429s"
+        f" {result['server_errors']:,} 5xx"
+    )
+
+
+def compare_with_baseline(result_list, baseline_file, tolerance):
+    # regressions beyond tolerance against the baseline run of the same scenario and concurrency
+    key_to_baseline = {}
+    with open(baseline_file, "r", encoding="utf8") as f:
+        for line in f:
+            baseline = json.loads(line)
+            key_to_baseline[(baseline["scenario"], baseline["concurrency"])] = baseline
+
+    regression_list = []
+    for result in result_list:
+        baseline = key_to_baseline.get((result["scenario"], result["concurrency"]))
+        if baseline is None:
+            continue
+        for name, higher_is_better in COMPARED_RESULT_TO_HIGHER_IS_BETTER.items():
+            ratio = result[name] / baseline[name] if baseline[name] else 1
+            if (higher_is_better and ratio < 1 - tolerance) or (not higher_is_better and ratio > 1 + tolerance):
+                regression_list.append(
+                    f"[regression] [{result['scenario']}] concurrency {result['concurrency']:,}"
+                    f" {name} {baseline[name]:,.1f} -> {result[name]:,.1f}"
+                )
+    return regression_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario_list", type=str, nargs="+", default=list(SCENARIO_TO_SETTING))
+    parser.add_argument("--concurrency_list", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--tasks", type=int, help="default: concurrency for openai scenarios, else 4x concurrency")
+    parser.add_argument("--max_task_runs", type=int, default=3)
+    parser.add_argument("--rpm", type=int, help="client quota of openai scenarios, default: 2x concurrency")
+    parser.add_argument("--tpm", type=int, help="client quota of openai scenarios, default: 10000 x concurrency")
+    parser.add_argument("--tokenizer", type=str, default="o200k_base", help="a tiktoken encoding, or bytes")
+    parser.add_argument("--packer", action="store_true", help="pack embedding rows into shared requests")
+    parser.add_argument("--texts_per_row", type=int, default=4)
+    parser.add_argument("--connections", type=int, default=1000, help="connection limit of the FedGPT client")
+    parser.add_argument("--output_file", type=str, help="append results as json lines")
+    parser.add_argument("--baseline_file", type=str, help="exit 1 on a regression against these results")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+    # mock server
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument(
+        "--latency_distribution", type=str, default="fixed", choices=["fixed", "uniform", "exponential", "lognormal"],
+    )
+    parser.add_argument("--error_rate", type=float, default=0)
+    parser.add_argument("--server_rpm", type=int)
+    parser.add_argument("--server_tpm", type=int)
+    parser.add_argument("--out_tokens", type=int, default=16)
+    parser.add_argument("--dimension", type=int, default=64)
+    arg = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    for name in ("async_utils", "httpx", "httpx2"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    for key, value in vars(arg).items():
+        if value is not None:
+            logger.info(f"[arg.{key}] {value}")
+
+    # every connection is a file descriptor, on both the client and the server
+    _soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    server_process = start_server_process(
+        arg.host, arg.port,
+        latency=arg.latency, latency_distribution=arg.latency_distribution, error_rate=arg.error_rate,
+        rpm=arg.server_rpm, tpm=arg.server_tpm, out_tokens=arg.out_tokens, dimension=arg.dimension,
+    )
+    work_dir = tempfile.mkdtemp(prefix="async_utils_benchmark_")
+    result_list = []
+    try:
+        for scenario in arg.scenario_list:
+            for concurrency in arg.concurrency_list:
+                tasks = arg.tasks
+                if tasks is None:
+                    tasks = concurrency if scenario.startswith("openai") else 4 * concurrency
+                result = asyncio.run(run_scenario(scenario, concurrency, tasks, arg, work_dir))
+                logger.info(get_result_string(result))
+                result_list.append(result)
+                if arg.output_file:
+                    with open(arg.output_file, "a", encoding="utf8") as f:
+                        json.dump(result, f)
+                        f.write("\n")
+    finally:
+        server_process.terminate()
+        server_process.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if arg.baseline_file:
+        regression_list = compare_with_baseline(result_list, arg.baseline_file, arg.tolerance)
+        for regression in regression_list:
+            logger.info(regression)
+        if regression_list:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
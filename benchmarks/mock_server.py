@@ -0,0 +1,256 @@
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class MockServer:
+    # a local stand-in for OpenAI-compatible chat and embeddings endpoints, and the FedGPT endpoint
+    # latency_distribution: "fixed", "uniform" (0 to 2x), "exponential", or "lognormal", all with mean latency
+    # rpm and tpm are enforced over a sliding minute, like the providers, with 429 and x-ratelimit headers
+    def __init__(
+            self, latency=0.5, latency_distribution="fixed", error_rate=0, rpm=None, tpm=None,
+            out_tokens=16, dimension=256, seed=None,
+    ):
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.tpm = tpm
+        self.out_tokens = out_tokens
+        self.dimension = dimension
+        self.random = random.Random(seed)
+
+        # (time, tokens) of requests accepted in the last minute
+        self.window = deque()
+        self.window_tokens = 0
+
+        self.stats = {}
+        self.reset_stats()
+        return
+
+    def reset_stats(self):
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "errors": 0,
+            "succeeded": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "tokens": 0,
+        }
+        return
+
+    def get_latency(self):
+        if self.latency_distribution == "uniform":
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_distribution == "exponential":
+            return self.random.expovariate(1 / self.latency) if self.latency > 0 else 0
+        if self.latency_distribution == "lognormal":
+            # sigma 1, scaled so that the mean is latency
+            return self.latency * self.random.lognormvariate(-0.5, 1)
+        return self.latency
+
+    def get_rate_limit_headers(self, now):
+        headers = {}
+        if self.rpm is not None:
+            reset = self.window[0][0] + 60 - now if self.window else 0
+            headers["x-ratelimit-limit-requests"] = str(self.rpm)
+            headers["x-ratelimit-remaining-requests"] = str(max(0, self.rpm - len(self.window)))
+            headers["x-ratelimit-reset-requests"] = f"{max(0, reset):.3f}s"
+        if self.tpm is not None:
+            reset = self.window[0][0] + 60 - now if self.window else 0
+            headers["x-ratelimit-limit-tokens"] = str(self.tpm)
+            headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tpm - self.window_tokens))
+            headers["x-ratelimit-reset-tokens"] = f"{max(0, reset):.3f}s"
+        return headers
+
+    def admit(self, tokens):
+        # (accepted, headers), counting the request against the window if accepted
+        now = time.time()
+        while self.window and self.window[0][0] <= now - 60:
+            _time, old_tokens = self.window.popleft()
+            self.window_tokens -= old_tokens
+
+        accepted = (self.rpm is None or len(self.window) < self.rpm) \
+            and (self.tpm is None or self.window_tokens + tokens <= self.tpm)
+        if accepted:
+            self.window.append((now, tokens))
+            self.window_tokens += tokens
+        headers = self.get_rate_limit_headers(now)
+        if not accepted:
+            # the earliest time that a window slot frees up
+            retry_after = self.window[0][0] + 60 - now if self.window else 1
+            headers["retry-after-ms"] = str(max(1, int(retry_after * 1000)))
+        return accepted, headers
+
+    async def handle(self, tokens, get_body):
+        self.stats["requests"] += 1
+        accepted, headers = self.admit(tokens)
+        if not accepted:
+            self.stats["rate_limited"] += 1
+            body = {"error": {"message": "mock rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            return web.json_response(body, status=429, headers=headers)
+
+        self.stats["in_flight"] += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+        try:
+            await asyncio.sleep(self.get_latency())
+        finally:
+            self.stats["in_flight"] -= 1
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            body = {"error": {"message": "mock server error", "type": "server_error", "code": None}}
+            return web.json_response(body, status=500, headers=headers)
+
+        self.stats["succeeded"] += 1
+        self.stats["tokens"] += tokens
+        return web.json_response(get_body(), headers=headers)
+
+    async def handle_chat(self, request):
+        obj = await request.json()
+        prompt_tokens = sum(len(message["content"]) // 4 + 1 for message in obj["messages"])
+        n = obj.get("n") or 1
+        completion_tokens = n * self.out_tokens
+
+        def get_body():
+            return {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": obj["model"],
+                "choices": [
+                    {
+                        "index": i,
+                        "message": {"role": "assistant", "content": " ".join(["mock"] * self.out_tokens)},
+                        "finish_reason": "stop",
+                    }
+                    for i in range(n)
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        return await self.handle(prompt_tokens + completion_tokens, get_body)
+
+    async def handle_embeddings(self, request):
+        obj = await request.json()
+        text_list = obj["input"] if isinstance(obj["input"], list) else [obj["input"]]
+        prompt_tokens = sum(len(text) // 4 + 1 for text in text_list)
+        dimension = obj.get("dimensions") or self.dimension
+
+        def get_body():
+            return {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [(i + 1) / len(text_list)] * dimension}
+                    for i in range(len(text_list))
+                ],
+                "model": obj["model"],
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+            }
+        return await self.handle(prompt_tokens, get_body)
+
+    async def handle_fedgpt(self, request):
+        obj = await request.json()
+        prompt_tokens = sum(len(message["content"]) // 4 + 1 for message in obj["messages"])
+
+        def get_body():
+            return {"messages": [{"role": "assistant", "content": " ".join(["mock"] * self.out_tokens)}]}
+        return await self.handle(prompt_tokens + self.out_tokens, get_body)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def handle_reset(self, request):
+        self.reset_stats()
+        self.window.clear()
+        self.window_tokens = 0
+        return web.json_response(self.stats)
+
+    def get_app(self):
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post("/v1/chat/completions", self.handle_chat)
+        app.router.add_post("/v1/embeddings", self.handle_embeddings)
+        app.router.add_post("/v1/openai/chat/completions", self.handle_chat)
+        app.router.add_post("/v1/openai/embeddings", self.handle_embeddings)
+        app.router.add_post("/fedgpt", self.handle_fedgpt)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_post("/reset", self.handle_reset)
+        return app
+
+
+def run_server(host="127.0.0.1", port=8000, **kwargs):
+    server = MockServer(**kwargs)
+    web.run_app(server.get_app(), host=host, port=port, backlog=4096, access_log=None, print=None)
+    return
+
+
+def start_server_process(host="127.0.0.1", port=8000, **kwargs):
+    # run the server in its own process, so that it does not share the event loop or the GIL with the client
+    process = multiprocessing.Process(target=run_server, args=(host, port), kwargs=kwargs, daemon=True)
+    process.start()
+
+    async def wait_ready():
+        async with aiohttp.ClientSession() as session:
+            for _ in range(100):
+                try:
+                    async with session.get(f"http://{host}:{port}/stats") as response:
+                        if response.status == 200:
+                            return True
+                except aiohttp.ClientConnectionError:
+                    pass
+                await asyncio.sleep(0.1)
+        return False
+
+    if not asyncio.run(wait_ready()):
+        process.terminate()
+        raise RuntimeError(f"mock server did not start on {host}:{port}")
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument(
+        "--latency_distribution", type=str, default="fixed", choices=["fixed", "uniform", "exponential", "lognormal"],
+    )
+    parser.add_argument("--error_rate", type=float, default=0)
+    parser.add_argument("--rpm", type=int)
+    parser.add_argument("--tpm", type=int)
+    parser.add_argument("--out_tokens", type=int, default=16)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--seed", type=int)
+    arg = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info(f"mock server on http://{arg.host}:{arg.port}")
+    run_server(
+        arg.host, arg.port,
+        latency=arg.latency, latency_distribution=arg.latency_distribution, error_rate=arg.error_rate,
+        rpm=arg.rpm, tpm=arg.tpm, out_tokens=arg.out_tokens, dimension=arg.dimension, seed=arg.seed,
+    )
+    return
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
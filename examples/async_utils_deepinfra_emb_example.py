@@ -6,7 +6,7 @@ import argparse
 
 from openai import AsyncOpenAI
 
-from async_utils import process_batch_data
+from async_utils import process_batch_data, EmbeddingStore, EmbeddingPacker
 from async_utils import DeepInfraEmbTaskDatum, DeepInfraQuotaManager
 from async_utils import deepinfra_emb_task_runner
 
@@ -19,34 +19,21 @@ logging.basicConfig(
 
 
 def show_result(arg):
-    import struct
     import numpy as np
+    from async_utils import EmbeddingStoreReader
 
-    emb_dimension = 1024
-    vector_size = emb_dimension * 8  # a float is 8 bytes
-
-    logger.info(f"reading embedding bytes...")
-    with open(arg.emb_file, "rb") as f:
-        emb_bytes = f.read()
-    total_bytes = len(emb_bytes)
-    expected_vectors = total_bytes / vector_size
-    logger.info(f"read {total_bytes:,} bytes, expected {expected_vectors:,} vectors")
+    logger.info(f"reading embedding store...")
+    reader = EmbeddingStoreReader(arg.emb_file)
+    logger.info(f"read {len(reader):,} vectors")
 
     logger.info("collecting embedding...")
-    bytes_i = 0
     data = []
     with open(arg.output_file, "r", encoding="utf8") as f:
         for line in f:
             datum = json.loads(line)
             text_list = datum["data"]["text_list"]
-            batch = []
-            for text in text_list:
-                bytes_j = bytes_i + vector_size
-                vector = [v[0] for v in struct.iter_unpack("d", emb_bytes[bytes_i:bytes_j])]
-                vector = np.array(vector, dtype=np.float64)
-                bytes_i = bytes_j
-                batch.append((text, vector))
-            data.append(batch)
+            vector_list = reader.get(datum["task_id"])
+            data.append(list(zip(text_list, vector_list)))
     logger.info(f"collected {len(data):,} batches")
 
     for batch in data:
@@ -91,7 +78,7 @@ def main():
         api_key=api_key,
         base_url="https://api.deepinfra.com/v1/openai",
     )
-    DeepInfraEmbTaskDatum.bytes_file = open(arg.emb_file, "wb")
+    DeepInfraEmbTaskDatum.emb_store = EmbeddingStore(arg.emb_file, dtype="float32")
 
     # model
     model = "BAAI/bge-m3"
@@ -132,7 +119,7 @@ def main():
     asyncio.run(process_batch_data(
         arg.input_file, arg.output_file, DeepInfraEmbTaskDatum, deepinfra_emb_task_runner, quota_manager,
         max_task_runs=3, start_id=None, end_id=None, ignore_and_rewrite_output_file=True,
-        sleep_interval=0.001,
+        sleep_interval=0.001, packer=EmbeddingPacker(),
     ))
     return
 
@@ -1,15 +1,42 @@
 from .async_utils import (
     process_batch_data,
+    iterate_batch_data,
+    load_input_index,
+    split_input_file,
+    process_batch_data_in_processes,
+    merge_output_files,
 
     BasicTaskDatum,
     BasicQuotaManager,
+    QuotaRecord,
+    RetryPolicy,
+    ClientPoolQuotaManager,
+    InputReader,
+    IterableInputReader,
+    OutputWriter,
+    JSONCodec,
+    RawJSON,
+    ResponseCache,
+    HTTPClient,
+    MetricsCollector,
+    LatencyHistogram,
+    CallbackMetricsSink,
+    LogMetricsSink,
+    PrometheusMetricsSink,
+    start_queue_logging,
     math_task_runner,
 
     OpenAITaskDatum,
     OpenAIQuotaManager,
+    OpenAIAdaptiveQuotaManager,
+    TokenCountCache,
     openai_task_runner,
     dummy_openai_task_runner,
 
+    EmbeddingStore,
+    EmbeddingStoreReader,
+    EmbeddingPacker,
+
     OpenAIEmbTaskDatum,
     openai_emb_task_runner,
 
@@ -1,29 +1,302 @@
 import os
+import re
 import json
 import time
+import math
 import heapq
 import random
+import hashlib
 import struct
+import sqlite3
 import asyncio
+import queue
 import logging
+import logging.handlers
+import bisect
 import datetime
-from collections import deque
+import threading
+import email.utils
+import itertools
+import contextlib
+import multiprocessing
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(message)s",
-    datefmt="%Y/%m/%d %H:%M:%S",
-    level=logging.INFO,
-)
 
 """
 basic
 """
 
 
+def iterate_heap_in_order(heap):
+    # lazily yield heap items in sorted order without modifying the heap
+    if not heap:
+        return
+    frontier = [(heap[0], 0)]
+    while frontier:
+        item, i = heapq.heappop(frontier)
+        yield item
+        for j in (2 * i + 1, 2 * i + 2):
+            if j < len(heap):
+                heapq.heappush(frontier, (heap[j], j))
+    return
+
+
+def get_rate_limit_headers(headers):
+    # keep only the rate limit headers of a response, or of the response attached to an exception
+    if headers is None:
+        return {}
+    return {
+        key.lower(): value
+        for key, value in headers.items()
+        if key.lower().startswith("x-ratelimit-")
+    }
+
+
+def get_exception_headers(exception):
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        headers = getattr(exception, "headers", None)
+    return get_rate_limit_headers(headers)
+
+
+def parse_duration(text):
+    # e.g. "1s", "6m0s", "20ms", "1h2m3.5s", or a number of seconds; 0 if it does not parse
+    if not isinstance(text, str):
+        return 0
+    seconds = parse_header_number(text)
+    if seconds is not None:
+        return max(0, seconds)
+    seconds = 0
+    for value, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", text):
+        seconds += float(value) * {"ms": 0.001, "h": 3600, "m": 60, "s": 1}[unit]
+    return seconds
+
+
+def parse_header_number(text):
+    # e.g. "1000" or "1000.0", or None if it does not parse
+    try:
+        number = float(text)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number):
+        return None
+    return number
+
+
+def parse_header_count(text):
+    # a rate limit header count, e.g. "1000", or None if it does not parse
+    number = parse_header_number(text)
+    if number is None:
+        return None
+    return int(number)
+
+
+class RawJSON:
+    # the undecoded json text of a field, written back to the output as is
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw
+        return
+
+
+JSON_OBJECT_START_PATTERN = re.compile(rb"\s*\{\s*")
+JSON_KEY_SEPARATOR_PATTERN = re.compile(rb"\s*:\s*")
+JSON_SCALAR_PATTERN = re.compile(rb"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null|NaN|-?Infinity")
+JSON_FIELD_END_PATTERN = re.compile(rb"\s*([,}])\s*")
+JSON_SCAN_ONCE = json.JSONDecoder().scan_once
+
+
+def skip_json_string(line, i):
+    # the end of the string starting with the quote at i, found with find() rather than by decoding it
+    j = i + 1
+    while True:
+        j = line.find(b'"', j)
+        if j < 0:
+            raise ValueError(f"unterminated string at byte {i}")
+        # the quote is escaped if it follows an odd number of backslashes
+        k = j
+        while line[k - 1] == 0x5C:
+            k -= 1
+        if (j - k) % 2 == 0:
+            return j + 1
+        j += 1
+
+
+def split_json_fields(line):
+    # (key, raw value) of every top-level field of a json object line
+    # strings, usually the bulk of a row, are skipped over without decoding, arrays and objects are scanned in C
+    match = JSON_OBJECT_START_PATTERN.match(line)
+    if not match:
+        raise ValueError("not a json object")
+    i = match.end()
+    field_list = []
+    if line[i:i + 1] == b"}":
+        return field_list
+
+    # the rest of the line from the first array or object on, decoded once for the scanner,
+    # with the byte and char offsets of a position in it
+    text = None
+    is_ascii = False
+    byte_offset = char_offset = 0
+
+    while True:
+        if line[i:i + 1] != b'"':
+            raise ValueError(f"expecting a key at byte {i}")
+        end = skip_json_string(line, i)
+        key_raw = line[i:end]
+        key = json.loads(key_raw) if b"\\" in key_raw else key_raw[1:-1].decode("utf8")
+        match = JSON_KEY_SEPARATOR_PATTERN.match(line, end)
+        if not match:
+            raise ValueError(f"expecting ':' at byte {end}")
+        i = match.end()
+
+        start_byte = line[i:i + 1]
+        if start_byte == b'"':
+            end = skip_json_string(line, i)
+        elif start_byte in (b"{", b"["):
+            if text is None:
+                is_ascii = line.isascii()
+                text = line[i:].decode("utf8")
+                byte_offset = i
+            if is_ascii:
+                char_start = i - byte_offset
+            else:
+                char_offset += len(line[byte_offset:i].decode("utf8"))
+                byte_offset = i
+                char_start = char_offset
+            try:
+                _value, char_end = JSON_SCAN_ONCE(text, char_start)
+            except StopIteration:
+                raise ValueError(f"expecting a value at byte {i}") from None
+            if is_ascii:
+                end = byte_offset + char_end
+            else:
+                end = i + len(text[char_start:char_end].encode("utf8"))
+                byte_offset = end
+                char_offset = char_end
+        else:
+            match = JSON_SCALAR_PATTERN.match(line, i)
+            if not match:
+                raise ValueError(f"expecting a value at byte {i}")
+            end = match.end()
+        field_list.append((key, line[i:end]))
+
+        match = JSON_FIELD_END_PATTERN.match(line, end)
+        if not match:
+            raise ValueError(f"expecting ',' or '}}' at byte {end}")
+        i = match.end()
+        if match.group(1) == b"}":
+            break
+    return field_list
+
+
+class JSONCodec:
+    # json for input and output rows with the standard library, orjson, or msgspec
+    # backend "auto" picks orjson, then msgspec, when installed, rows they cannot handle fall back to the standard library
+    # orjson and msgspec read NaN and Infinity through the fallback but write them as null
+    def __init__(self, backend="auto"):
+        if backend == "auto":
+            backend = "orjson" if orjson is not None else "msgspec" if msgspec is not None else "json"
+        self.backend = backend
+        if backend == "msgspec":
+            self.encoder = msgspec.json.Encoder(enc_hook=self.encode_raw_json)
+            self.decoder = msgspec.json.Decoder()
+            self.field_decoder = msgspec.json.Decoder(dict[str, msgspec.Raw])
+        # orjson before 3.9 has no Fragment to write RawJSON with
+        self.native_raw_json = backend == "msgspec" or backend == "orjson" and hasattr(orjson, "Fragment")
+        self.item_separator = b", " if backend == "json" else b","
+        self.key_separator = b": " if backend == "json" else b":"
+        return
+
+    def loads(self, text):
+        try:
+            if self.backend == "orjson":
+                return orjson.loads(text)
+            if self.backend == "msgspec":
+                return self.decoder.decode(text)
+        except ValueError:
+            # e.g. NaN, which the standard library accepts
+            pass
+        return json.loads(text)
+
+    def encode_raw_json(self, obj):
+        if isinstance(obj, RawJSON) and self.native_raw_json:
+            return orjson.Fragment(obj.raw) if self.backend == "orjson" else msgspec.Raw(obj.raw)
+        raise TypeError(f"{type(obj).__name__} is not json serializable")
+
+    def encode(self, obj):
+        if self.backend == "orjson":
+            return orjson.dumps(obj, default=self.encode_raw_json)
+        return self.encoder.encode(obj)
+
+    def dumps(self, obj):
+        if self.backend != "json":
+            try:
+                return self.encode(obj)
+            except (TypeError, ValueError, OverflowError):
+                # e.g. integers beyond 64 bits or non-string keys
+                pass
+        return json.dumps(obj, ensure_ascii=False).encode("utf8")
+
+    def dumps_object(self, obj):
+        # a dict whose RawJSON values are written as is
+        if self.native_raw_json:
+            try:
+                return self.encode(obj)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        return b"{" + self.item_separator.join(
+            self.dumps(key) + self.key_separator + (value.raw if isinstance(value, RawJSON) else self.dumps(value))
+            for key, value in obj.items()
+        ) + b"}"
+
+    def split_fields(self, line):
+        if self.backend == "msgspec":
+            try:
+                return [(key, bytes(raw)) for key, raw in self.field_decoder.decode(line).items()]
+            except ValueError:
+                # e.g. NaN, as in loads()
+                pass
+        return split_json_fields(line)
+
+    def loads_fields(self, line, field_set):
+        # a json object with only the fields in field_set decoded, the others kept as RawJSON
+        # orjson decodes a whole row faster than the fields can be split out of it
+        if self.backend == "orjson":
+            return self.loads(line)
+        return {
+            key: self.loads(raw) if key in field_set else RawJSON(raw)
+            for key, raw in self.split_fields(line)
+        }
+
+
 class BasicTaskDatum:
+    # data fields the task reads, the others stay RawJSON and are spliced into the output unchanged
+    # None decodes every field, e.g. set a datum class's input_fields to its read_fields
+    input_fields = None
+
     def __init__(
             self, task_id, data,
     ):
@@ -33,6 +306,11 @@ class BasicTaskDatum:
         self.run_id = 0
         self.start_time = 0
         self.end_time = 0
+        self.quota_tokens = 0
+        self.response_headers = {}
+        self.throttled_runs = 0
+        self.run_failed = False
+        self.error_status = None
         return
 
     def get_log_string(self):
@@ -50,147 +328,1920 @@ class BasicTaskDatum:
         }
         return json_obj
 
+    def get_json_bytes(self, json_codec):
+        # the output row, with undecoded input fields as they were read
+        json_obj = self.get_json_obj()
+        if self.input_fields is None:
+            return json_codec.dumps(json_obj)
+        json_obj["data"] = RawJSON(json_codec.dumps_object(json_obj["data"]))
+        return json_codec.dumps_object(json_obj)
+
+    def get_estimated_tokens(self):
+        # tokens to reserve against a tokens-per-minute quota before a run
+        return self.data.get("in_tokens", 0)
+
+    def get_used_tokens(self):
+        # tokens actually consumed by the last run, or None if unknown
+        return self.data.get("usage_tokens")
+
+    def get_cache_key(self):
+        # json-serializable description of everything that determines the response, or None if not cacheable
+        return None
+
+    def get_cache_value(self):
+        # json-serializable response data to store in a response cache
+        return None
+
+    def set_cache_value(self, value):
+        return
+
+    @classmethod
+    def prepare_data_list(cls, data_list):
+        # batch preprocessing of input data before datum construction, run on the input reader thread
+        return
+
+    @classmethod
+    async def start_job(cls, completed_task_id_set):
+        # open class-level resources of a job, e.g. output sinks or sessions
+        return
+
+    @classmethod
+    async def end_job(cls):
+        return
+
+    @classmethod
+    def flush_job(cls, fsync):
+        # called before each output commit, side outputs of finished tasks must be written out before their rows
+        return
+
     def finish(self):
         return
 
+    def release(self):
+        # drop the payload once the datum is finished and written, anything still referencing it keeps little alive
+        self.data = None
+        self.response_headers = {}
+        return
+
+
+def get_quota_share(limit, quota_share):
+    return max(1, int(limit * quota_share))
+
+
+class QuotaRecord:
+    # what quota managers need of a done run during its 60-second window, instead of the whole task datum
+    __slots__ = ("quota_tokens", "pool_member")
+
+    def __init__(self, done_task_datum):
+        self.quota_tokens = done_task_datum.quota_tokens
+        self.pool_member = getattr(done_task_datum, "pool_member", None)
+        return
+
 
 class BasicQuotaManager:
+    # done runs enter a heap of (end_time, id, QuotaRecord) that reclaim_quota() consumes
+    # managers that reclaim quota in settle_quota() set this to False and the heap stays empty
+    uses_done_queue = True
+
     def __init__(self):
         self.runs_per_minute = 5
+        self.runs_per_minute_limit = 5
+        self.quota_share = 1
+        return
+
+    def set_quota_share(self, quota_share):
+        # scale the quota to a share of the configured limits, e.g. for one of several worker processes
+        self.runs_per_minute += get_quota_share(self.runs_per_minute_limit, quota_share) \
+            - get_quota_share(self.runs_per_minute_limit, self.quota_share)
+        self.quota_share = quota_share
         return
 
+    def get_headroom(self):
+        # fraction of the quota that is available now
+        return self.runs_per_minute / get_quota_share(self.runs_per_minute_limit, self.quota_share)
+
+    def get_usage(self):
+        # quota name -> (used, limit), e.g. for metrics
+        limit = get_quota_share(self.runs_per_minute_limit, self.quota_share)
+        return {"runs": (limit - self.runs_per_minute, limit)}
+
     def has_enough_quota(self, init_task_datum):
         return self.runs_per_minute > 0
 
     def reclaim_quota(self, done_task_datum_queue):
         while done_task_datum_queue:
-            end_time, _done_task_datum_queue_id, _done_task_datum = done_task_datum_queue[0]
+            end_time, _done_task_datum_queue_id, _quota_record = done_task_datum_queue[0]
             if end_time >= time.time() - 60:
                 break
             heapq.heappop(done_task_datum_queue)
             self.runs_per_minute += 1
         return
 
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        # the earliest time has_enough_quota() may become true, or None if that depends on running tasks
+        if self.has_enough_quota(init_task_datum):
+            return time.time()
+        if not done_task_datum_queue:
+            return None
+        end_time, _done_task_datum_queue_id, _quota_record = done_task_datum_queue[0]
+        return end_time + 60
+
     def deduct_quota(self, init_task_datum):
         self.runs_per_minute -= 1
         return
 
+    def settle_quota(self, done_task_datum):
+        return
 
-async def process_batch_data(
-        input_file, output_file, task_datum_class, task_runner, quota_manager,
-        max_task_runs=1, start_id=None, end_id=None, ignore_and_rewrite_output_file=False,
-        sleep_interval=0.001,
+
+def get_exception_status(exception):
+    # e.g. openai.APIStatusError.status_code, aiohttp.ClientResponseError.status
+    for status in (
+            getattr(exception, "status_code", None),
+            getattr(exception, "status", None),
+            getattr(getattr(exception, "response", None), "status_code", None),
+    ):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def get_retry_after(exception):
+    # seconds from the Retry-After header of the response attached to an exception, or None
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        headers = getattr(exception, "headers", None)
+    if headers is None:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(
+            self, base_delay=1, max_delay=60, multiplier=2, jitter=0.5,
+            fatal_status_set=(400, 401, 403, 404, 422), throttled_status_set=(429,), max_throttled_runs=100,
+    ):
+        # max_throttled_runs: throttled runs of a task before it quits, e.g. on a daily cap, None to retry forever
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.fatal_status_set = set(fatal_status_set)
+        self.throttled_status_set = set(throttled_status_set)
+        self.max_throttled_runs = max_throttled_runs
+        return
+
+    def has_retry(self, task_datum, retry_type, max_task_runs):
+        if retry_type == "fatal":
+            return False
+        if retry_type == "throttled":
+            return self.max_throttled_runs is None or task_datum.throttled_runs < self.max_throttled_runs
+        return task_datum.run_id - task_datum.throttled_runs < max_task_runs
+
+    def classify_exception(self, exception):
+        # "fatal": do not retry; "throttled": retry without spending a run; "retry": retry and spend a run
+        # aiohttp.ClientResponseError.code is a deprecated alias of the status
+        if not isinstance(exception, aiohttp.ClientResponseError) and getattr(exception, "code", None) == "insufficient_quota":
+            return "fatal"
+        status = get_exception_status(exception)
+        if status in self.fatal_status_set:
+            return "fatal"
+        if status in self.throttled_status_set:
+            return "throttled"
+        return "retry"
+
+    def get_retry_delay(self, task_datum, exception):
+        retry_after = get_retry_after(exception)
+        if retry_after is not None:
+            return max(0, retry_after)
+
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (task_datum.run_id - 1))
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+
+class ClientPoolQuotaManager:
+    # route each run to the pool member with enough quota and the most headroom, every member has its own quota
+    # member_list: (attributes to set on the task datum, e.g. {"client": client} or {"api_key": key}, quota manager)
+    # a member whose runs fail with 429, 5xx, or no status (e.g. a connection error) cools down, longer on repeats
+    def __init__(self, member_list, cooldown=1, max_cooldown=60, failover_status_set=(429,)):
+        self.attribute_dict_list = [attribute_dict for attribute_dict, _quota_manager in member_list]
+        self.quota_manager_list = [quota_manager for _attribute_dict, quota_manager in member_list]
+        self.done_task_datum_queue_list = [[] for _member in member_list]
+        self.uses_done_queue = any(
+            getattr(quota_manager, "uses_done_queue", True) for quota_manager in self.quota_manager_list
+        )
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failover_status_set = set(failover_status_set)
+
+        self.failures_list = [0] * len(member_list)
+        self.cooldown_start_time_list = [0] * len(member_list)
+        self.cooldown_end_time_list = [0] * len(member_list)
+        self.runs_list = [0] * len(member_list)
+        return
+
+    def is_failover_status(self, status):
+        return status is None or status in self.failover_status_set or status >= 500
+
+    def distribute_done_task_datum_queue(self, done_task_datum_queue):
+        # a done task goes back to the quota window of the member that ran it, if that member keeps one
+        while done_task_datum_queue:
+            item = heapq.heappop(done_task_datum_queue)
+            member = item[2].pool_member
+            if getattr(self.quota_manager_list[member], "uses_done_queue", True):
+                heapq.heappush(self.done_task_datum_queue_list[member], item)
+        return
+
+    def get_member(self, init_task_datum):
+        # the member to run a task datum now, or None
+        now = time.time()
+        best_member = None
+        best_headroom = None
+        for member, quota_manager in enumerate(self.quota_manager_list):
+            if now < self.cooldown_end_time_list[member] or not quota_manager.has_enough_quota(init_task_datum):
+                continue
+            headroom = quota_manager.get_headroom()
+            if best_member is None or headroom > best_headroom:
+                best_member = member
+                best_headroom = headroom
+        return best_member
+
+    def has_enough_quota(self, init_task_datum):
+        return self.get_member(init_task_datum) is not None
+
+    def reclaim_quota(self, done_task_datum_queue):
+        self.distribute_done_task_datum_queue(done_task_datum_queue)
+        for quota_manager, member_done_task_datum_queue in zip(
+                self.quota_manager_list, self.done_task_datum_queue_list,
+        ):
+            quota_manager.reclaim_quota(member_done_task_datum_queue)
+        return
+
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        self.distribute_done_task_datum_queue(done_task_datum_queue)
+        quota_time = None
+        for member, quota_manager in enumerate(self.quota_manager_list):
+            member_quota_time = quota_manager.get_quota_available_time(
+                init_task_datum, self.done_task_datum_queue_list[member],
+            )
+            if member_quota_time is None:
+                continue
+            member_quota_time = max(member_quota_time, self.cooldown_end_time_list[member])
+            if quota_time is None or member_quota_time < quota_time:
+                quota_time = member_quota_time
+        return quota_time
+
+    def deduct_quota(self, init_task_datum):
+        member = self.get_member(init_task_datum)
+        for key, value in self.attribute_dict_list[member].items():
+            setattr(init_task_datum, key, value)
+        init_task_datum.pool_member = member
+        self.quota_manager_list[member].deduct_quota(init_task_datum)
+        self.runs_list[member] += 1
+        return
+
+    def settle_quota(self, done_task_datum):
+        member = done_task_datum.pool_member
+        self.quota_manager_list[member].settle_quota(done_task_datum)
+
+        if not done_task_datum.run_failed:
+            self.failures_list[member] = 0
+        elif self.is_failover_status(done_task_datum.error_status):
+            # runs sent before the current cooldown started do not extend it
+            if done_task_datum.start_time >= self.cooldown_start_time_list[member]:
+                self.failures_list[member] += 1
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self.failures_list[member] - 1))
+                self.cooldown_start_time_list[member] = time.time()
+                self.cooldown_end_time_list[member] = time.time() + cooldown
+                logger.info(f"[client pool] member#{member} cools down for {cooldown:.1f}s")
+        return
+
+    def set_quota_share(self, quota_share):
+        for quota_manager in self.quota_manager_list:
+            quota_manager.set_quota_share(quota_share)
+        return
+
+    def get_headroom(self):
+        return max(quota_manager.get_headroom() for quota_manager in self.quota_manager_list)
+
+    def get_usage(self):
+        return {
+            f"member{member}_{name}": usage
+            for member, quota_manager in enumerate(self.quota_manager_list)
+            for name, usage in quota_manager.get_usage().items()
+        }
+
+    def get_log_string(self):
+        return "[client pool] runs " + ", ".join(
+            f"member#{member}={runs:,}"
+            for member, runs in enumerate(self.runs_list)
+        )
+
+
+# input file size and mtime, followed by the byte offset of every line
+INPUT_INDEX_HEADER = struct.Struct("<qq")
+
+
+def get_input_index_file(input_file):
+    return input_file + ".offsets"
+
+
+def load_input_index(input_file):
+    # line start offsets of the input file, built once and stored next to it
+    stat = os.stat(input_file)
+    index_file = get_input_index_file(input_file)
+
+    if os.path.exists(index_file):
+        with open(index_file, "rb") as f:
+            header = f.read(INPUT_INDEX_HEADER.size)
+            if len(header) == INPUT_INDEX_HEADER.size and INPUT_INDEX_HEADER.unpack(header) == (stat.st_size, stat.st_mtime_ns):
+                offset_array = array("q")
+                offset_array.frombytes(f.read())
+                return offset_array
+
+    logger.info(f"building line index of {input_file}")
+    offset_array = array("q")
+    position = 0
+    with open(input_file, "rb") as f:
+        for line in f:
+            offset_array.append(position)
+            position += len(line)
+
+    tmp_index_file = index_file + ".tmp"
+    with open(tmp_index_file, "wb") as f:
+        f.write(INPUT_INDEX_HEADER.pack(stat.st_size, stat.st_mtime_ns))
+        f.write(offset_array.tobytes())
+    os.replace(tmp_index_file, index_file)
+    return offset_array
+
+
+def split_input_file(input_file, shards, start_id=None, end_id=None):
+    # split input lines, optionally within [start_id, end_id], into at most shards ranges of about the same bytes
+    offset_array = load_input_index(input_file)
+    first_id = 1 if start_id is None else max(start_id, 1)
+    last_id = len(offset_array) if end_id is None else min(end_id, len(offset_array))
+    if first_id > last_id:
+        return []
+    begin_offset = offset_array[first_id - 1]
+    end_offset = offset_array[last_id] if last_id < len(offset_array) else os.path.getsize(input_file)
+    total_bytes = end_offset - begin_offset
+
+    range_list = []
+    shard_start_id = first_id
+    for shard in range(1, shards + 1):
+        if shard_start_id > last_id:
+            break
+        if shard == shards:
+            shard_end_id = last_id
+        else:
+            # the last line that starts before the byte boundary of this shard
+            shard_end_id = bisect.bisect_left(offset_array, begin_offset + total_bytes * shard // shards)
+            shard_end_id = min(max(shard_end_id, shard_start_id), last_id)
+        range_list.append((shard_start_id, shard_end_id))
+        shard_start_id = shard_end_id + 1
+    return range_list
+
+
+class InputReader:
+    # read, decode, and prepare input lines ahead of dispatch, on a worker thread into a buffer bounded by rows and bytes
+    def __init__(self, max_rows=10000, max_bytes=64 << 20, batch_rows=64, use_thread=True, json_codec=None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.batch_rows = batch_rows
+        self.use_thread = use_thread
+        self.json_codec = JSONCodec() if json_codec is None else json_codec
+
+        self.input_file = None
+        self.task_datum_class = None
+        self.start_id = None
+        self.end_id = None
+        self.completed_task_id_set = None
+        self.use_input_index = False
+        self.fr = None
+        self.input_task_id = 0
+
+        # progress: bytes of the id range, bytes read, and bytes of lines skipped as out of range or completed
+        self.range_bytes = None
+        self.read_bytes = 0
+        self.skipped_bytes = 0
+
+        self.buffer = deque()
+        self.buffer_bytes = 0
+        self.condition = threading.Condition()
+        self.no_more_input = False
+        self.closed = False
+        self.exception = None
+        self.thread = None
+        self.loop = None
+        self.wakeup_event = None
+        return
+
+    def set_input_file(
+            self, input_file, start_id=None, end_id=None, completed_task_id_set=None, use_input_index=False,
+    ):
+        self.input_file = input_file
+        self.start_id = start_id
+        self.end_id = end_id
+        self.completed_task_id_set = set() if completed_task_id_set is None else completed_task_id_set
+        self.use_input_index = use_input_index
+        return
+
+    def reset(self):
+        # state of a single run, so a reader can be opened again after close(), e.g. for the next input file
+        assert self.thread is None
+        self.input_task_id = 0
+        self.buffer = deque()
+        self.buffer_bytes = 0
+        self.no_more_input = False
+        self.closed = False
+        self.exception = None
+        self.loop = None
+        self.wakeup_event = None
+        return
+
+    def open(self, task_datum_class, wakeup_event):
+        self.reset()
+        self.task_datum_class = task_datum_class
+        self.fr = open(self.input_file, "rb")
+        offset_array = None
+        if self.use_input_index and (self.start_id is not None or self.end_id is not None):
+            offset_array = load_input_index(self.input_file)
+        if offset_array is not None and self.start_id is not None and self.start_id > 1:
+            if self.start_id > len(offset_array):
+                self.no_more_input = True
+            else:
+                self.fr.seek(offset_array[self.start_id - 1])
+                self.input_task_id = self.start_id - 1
+
+        range_end = os.fstat(self.fr.fileno()).st_size
+        if self.end_id is not None:
+            if offset_array is None:
+                range_end = None
+            elif 0 <= self.end_id < len(offset_array):
+                range_end = offset_array[self.end_id]
+        self.range_bytes = None if range_end is None else max(0, range_end - self.fr.tell())
+        self.read_bytes = 0
+        self.skipped_bytes = 0
+
+        if self.use_thread and not self.no_more_input:
+            self.start_thread(wakeup_event)
+        return
+
+    def start_thread(self, wakeup_event):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup_event = wakeup_event
+        self.thread = threading.Thread(target=self.run, name="input_reader", daemon=True)
+        self.thread.start()
+        return
+
+    def read_batch(self, batch_rows):
+        # up to batch_rows (task_id, data, line bytes) of unfinished tasks in the id range
+        batch = []
+        input_fields = self.task_datum_class.input_fields
+        if input_fields is not None:
+            input_fields = set(input_fields)
+        while len(batch) < batch_rows:
+            line = self.fr.readline()
+            if not line:
+                self.no_more_input = True
+                break
+            self.input_task_id += 1
+            if self.start_id is not None and self.input_task_id < self.start_id:
+                self.read_bytes += len(line)
+                self.skipped_bytes += len(line)
+                continue
+            if self.end_id is not None and self.input_task_id > self.end_id:
+                self.no_more_input = True
+                break
+            self.read_bytes += len(line)
+            if self.input_task_id in self.completed_task_id_set:
+                self.skipped_bytes += len(line)
+                continue
+            if input_fields is None:
+                data = self.json_codec.loads(line)
+            else:
+                data = self.json_codec.loads_fields(line, input_fields)
+            batch.append((self.input_task_id, data, len(line)))
+
+        if batch:
+            self.task_datum_class.prepare_data_list([data for _task_id, data, _line_bytes in batch])
+        return batch
+
+    def run(self):
+        try:
+            while not self.no_more_input and not self.closed:
+                batch = self.read_batch(self.batch_rows)
+                with self.condition:
+                    while not self.closed and (
+                            len(self.buffer) >= self.max_rows or self.buffer_bytes >= self.max_bytes
+                    ):
+                        self.condition.wait()
+                    was_empty = not self.buffer
+                    self.buffer.extend(batch)
+                    self.buffer_bytes += sum(line_bytes for _task_id, _data, line_bytes in batch)
+                if was_empty and batch:
+                    self.loop.call_soon_threadsafe(self.wakeup_event.set)
+        except BaseException as e:
+            self.exception = e
+        finally:
+            with self.condition:
+                self.no_more_input = True
+            if not self.closed:
+                self.loop.call_soon_threadsafe(self.wakeup_event.set)
+        return
+
+    def get(self):
+        # the next (task_id, data) if one is ready now, else None
+        if self.exception is not None:
+            raise self.exception
+        if self.thread is None:
+            if not self.buffer and not self.no_more_input:
+                self.buffer.extend(self.read_batch(1))
+            if not self.buffer:
+                return None
+            task_id, data, _line_bytes = self.buffer.popleft()
+            return task_id, data
+
+        with self.condition:
+            if not self.buffer:
+                return None
+            task_id, data, line_bytes = self.buffer.popleft()
+            self.buffer_bytes -= line_bytes
+            self.condition.notify()
+        return task_id, data
+
+    def is_done(self):
+        # no more input will ever be ready
+        if self.exception is not None:
+            raise self.exception
+        with self.condition:
+            return self.no_more_input and not self.buffer
+
+    def get_progress(self):
+        # fraction of the input handed out so far, or None if the size of the id range is unknown
+        if self.range_bytes is None:
+            return None
+        handed_out_bytes = self.read_bytes - self.skipped_bytes - self.buffer_bytes
+        return min(1, handed_out_bytes / max(1, self.range_bytes - self.skipped_bytes))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.fr is not None:
+            self.fr.close()
+            self.fr = None
+        return
+
+
+class IterableInputReader(InputReader):
+    # input data dicts from an iterable, read on a worker thread, or from an async iterable, read on the event loop
+    # task ids count from 1 in iteration order
+    def __init__(self, data_iterable, max_rows=10000, batch_rows=64, use_thread=True):
+        super().__init__(max_rows=max_rows, batch_rows=batch_rows, use_thread=use_thread)
+        self.data_iterable = data_iterable
+        self.data_iterator = None
+
+        # async iterables: data read but not yet prepared, and the task reading them
+        self.pending_list = []
+        self.pump_task = None
+        self.space_event = None
+        return
+
+    def reset(self):
+        assert self.pump_task is None
+        super().reset()
+        self.pending_list = []
+        self.space_event = None
+        return
+
+    def open(self, task_datum_class, wakeup_event):
+        # a one-shot iterator, e.g. a generator, has no data left for a second run
+        self.reset()
+        self.task_datum_class = task_datum_class
+        if hasattr(self.data_iterable, "__aiter__"):
+            self.data_iterator = self.data_iterable.__aiter__()
+            self.wakeup_event = wakeup_event
+            self.space_event = asyncio.Event()
+            self.pump_task = asyncio.create_task(self.pump())
+        else:
+            self.data_iterator = iter(self.data_iterable)
+            if self.use_thread:
+                self.start_thread(wakeup_event)
+        return
+
+    def read_batch(self, batch_rows):
+        batch = []
+        for data in itertools.islice(self.data_iterator, batch_rows):
+            self.input_task_id += 1
+            batch.append((self.input_task_id, data, 0))
+        if len(batch) < batch_rows:
+            self.no_more_input = True
+        if batch:
+            self.task_datum_class.prepare_data_list([data for _task_id, data, _line_bytes in batch])
+        return batch
+
+    def prepare_pending_list(self):
+        # prepare data read so far on the event loop, when the scheduler is waiting for it
+        batch = self.pending_list
+        self.pending_list = []
+        self.task_datum_class.prepare_data_list([data for _task_id, data in batch])
+        self.buffer.extend(batch)
+        return
+
+    async def pump(self):
+        try:
+            async for data in self.data_iterator:
+                self.input_task_id += 1
+                self.pending_list.append((self.input_task_id, data))
+                if len(self.pending_list) >= self.batch_rows:
+                    # a full batch is prepared off the loop
+                    batch = self.pending_list
+                    self.pending_list = []
+                    await asyncio.to_thread(self.task_datum_class.prepare_data_list, [data for _task_id, data in batch])
+                    self.buffer.extend(batch)
+                self.wakeup_event.set()
+                while len(self.buffer) + len(self.pending_list) >= self.max_rows:
+                    self.space_event.clear()
+                    await self.space_event.wait()
+            if self.pending_list:
+                self.prepare_pending_list()
+        except Exception as e:
+            self.exception = e
+        finally:
+            self.no_more_input = True
+            self.wakeup_event.set()
+        return
+
+    def get(self):
+        if self.pump_task is None:
+            return super().get()
+        if self.exception is not None:
+            raise self.exception
+        if not self.buffer and self.pending_list:
+            self.prepare_pending_list()
+        if not self.buffer:
+            return None
+        task_id, data = self.buffer.popleft()
+        self.space_event.set()
+        return task_id, data
+
+    def is_done(self):
+        if self.pump_task is None:
+            return super().is_done()
+        if self.exception is not None:
+            raise self.exception
+        return self.no_more_input and not self.buffer and not self.pending_list
+
+    def get_progress(self):
+        # only known for sized iterables
+        if not hasattr(self.data_iterable, "__len__"):
+            return None
+        handed_out = self.input_task_id - len(self.buffer) - len(self.pending_list)
+        return min(1, handed_out / max(1, len(self.data_iterable)))
+
+    def close(self):
+        if self.pump_task is not None:
+            self.pump_task.cancel()
+            self.pump_task = None
+        super().close()
+        return
+
+
+def truncate_partial_line(file):
+    # drop a trailing line without newline, e.g. left by a crash in the middle of a write
+    with open(file, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            chunk_size = min(65536, position)
+            f.seek(position - chunk_size)
+            chunk = f.read(chunk_size)
+            newline_index = chunk.rfind(b"\n")
+            if newline_index >= 0:
+                position = position - chunk_size + newline_index + 1
+                break
+            position -= chunk_size
+        if position < end:
+            f.truncate(position)
+    return end - position
+
+
+# (task_id, end offset of the row in the output file)
+CHECKPOINT_RECORD = struct.Struct("<qq")
+TASK_ID_PATTERN = re.compile(rb'\{"task_id": ?(-?\d+)[,}]')
+
+
+def get_checkpoint_file(output_file):
+    return output_file + ".ckpt"
+
+
+def extract_task_id(line):
+    # rows written by this module start with the task_id, so avoid decoding the whole row
+    match = TASK_ID_PATTERN.match(line)
+    if match:
+        return int(match.group(1))
+    return json.loads(line)["task_id"]
+
+
+def read_checkpoint(checkpoint_file, output_file):
+    # (task_id array, offset array) of the checkpoint if it is consistent with the output file, else None
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, "rb") as f:
+        checkpoint_bytes = f.read()
+    checkpoint_bytes = checkpoint_bytes[:len(checkpoint_bytes) - len(checkpoint_bytes) % CHECKPOINT_RECORD.size]
+    records = array("q")
+    records.frombytes(checkpoint_bytes)
+    task_id_array = records[0::2]
+    offset_array = records[1::2]
+    if not offset_array:
+        return task_id_array, offset_array
+
+    # the first and the last checkpointed rows must still be in the output file
+    if offset_array[-1] > os.path.getsize(output_file):
+        return None
+    with open(output_file, "rb") as f:
+        for index in (0, len(offset_array) - 1):
+            start = offset_array[index - 1] if index > 0 else 0
+            end = offset_array[index]
+            if end <= start:
+                return None
+            f.seek(start)
+            line = f.read(end - start)
+            try:
+                if not line.endswith(b"\n") or extract_task_id(line) != task_id_array[index]:
+                    return None
+            except (ValueError, KeyError, TypeError):
+                return None
+    return task_id_array, offset_array
+
+
+def load_completed_task_id_set(output_file):
+    # load task ids from the checkpoint sidecar, and only parse output rows the checkpoint does not cover
+    checkpoint_file = get_checkpoint_file(output_file)
+    checkpoint = read_checkpoint(checkpoint_file, output_file)
+    if checkpoint is None:
+        logger.info(f"no valid checkpoint for {output_file}, scanning the whole file")
+        task_id_array, offset_array = array("q"), array("q")
+        start = 0
+    else:
+        task_id_array, offset_array = checkpoint
+        start = offset_array[-1] if offset_array else 0
+
+    tail_record_list = []
+    with open(output_file, "rb") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            offset += len(line)
+            tail_record_list.append(CHECKPOINT_RECORD.pack(extract_task_id(line), offset))
+
+    completed_task_id_set = set(task_id_array)
+    completed_task_id_set.update(task_id for task_id, _offset in CHECKPOINT_RECORD.iter_unpack(b"".join(tail_record_list)))
+
+    # bring the checkpoint up to date with the output file
+    if checkpoint is None:
+        tmp_checkpoint_file = checkpoint_file + ".tmp"
+        with open(tmp_checkpoint_file, "wb") as f:
+            f.write(b"".join(tail_record_list))
+        os.replace(tmp_checkpoint_file, checkpoint_file)
+    elif tail_record_list:
+        with open(checkpoint_file, "ab") as f:
+            f.truncate(len(task_id_array) * CHECKPOINT_RECORD.size)
+            f.write(b"".join(tail_record_list))
+    return completed_task_id_set
+
+
+class OutputWriter:
+    # group commit: rows are serialized on write() and committed together by count, bytes, or latency
+    # with checkpoint, the task_id and end offset of every committed row are appended to a sidecar file
+    def __init__(
+            self, max_rows=1000, max_bytes=1 << 20, max_latency=0.1, use_thread=False, fsync=False,
+            checkpoint=True, json_codec=None,
+    ):
+        self.json_codec = JSONCodec() if json_codec is None else json_codec
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.use_thread = use_thread
+        self.fsync = fsync
+        self.checkpoint = checkpoint
+
+        self.file = None
+        self.checkpoint_file = None
+        self.before_commit = None
+        self.offset = 0
+        self.row_list = []
+        self.row_bytes = 0
+        self.checkpoint_record_list = []
+        self.flush_timer = None
+        self.executor = None
+        self.exception = None
+        return
+
+    def open(self, file, mode, before_commit=None):
+        # before_commit(fsync) runs before every group commit, e.g. to flush sinks the rows depend on
+        self.before_commit = before_commit
+        self.exception = None
+        self.file = open(file, mode + "b")
+        self.offset = self.file.seek(0, os.SEEK_END)
+        checkpoint_file = get_checkpoint_file(file)
+        if self.checkpoint:
+            # an empty output file has no rows, so records left in the sidecar, e.g. of a deleted output file, are stale
+            self.checkpoint_file = open(checkpoint_file, "wb" if self.offset == 0 else mode + "b")
+        elif os.path.exists(checkpoint_file):
+            # a checkpoint that is not kept up to date would go stale
+            os.remove(checkpoint_file)
+        if self.use_thread:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output_writer")
+        return
+
+    def write(self, json_obj):
+        self.write_row(json_obj["task_id"], self.json_codec.dumps(json_obj))
+        return
+
+    def write_row(self, task_id, row):
+        # row: the encoded json object, without the line break
+        if self.exception is not None:
+            raise self.exception
+        row += b"\n"
+        self.row_list.append(row)
+        self.row_bytes += len(row)
+        self.offset += len(row)
+        if self.checkpoint_file is not None:
+            self.checkpoint_record_list.append(CHECKPOINT_RECORD.pack(task_id, self.offset))
+
+        if len(self.row_list) >= self.max_rows or self.row_bytes >= self.max_bytes:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.max_latency, self.flush_on_timer)
+        return
+
+    def flush_on_timer(self):
+        # an error is kept in self.exception and raised by the next write_row() or close(), not by the event loop
+        self.flush_timer = None
+        try:
+            self.flush()
+        except Exception:
+            pass
+        return
+
+    def commit(self, chunk, checkpoint_chunk):
+        # a group is a single write of whole lines, so a crash can only leave one partial line at the end
+        if self.before_commit is not None:
+            self.before_commit(self.fsync)
+        self.file.write(chunk)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+        # rows are committed before their checkpoint records, so the checkpoint never runs ahead
+        if self.checkpoint_file is not None:
+            self.checkpoint_file.write(checkpoint_chunk)
+            self.checkpoint_file.flush()
+        return
+
+    def commit_done_callback(self, future):
+        if future.exception() is not None and self.exception is None:
+            self.exception = future.exception()
+        return
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.exception is not None:
+            raise self.exception
+        if not self.row_list:
+            return
+
+        chunk = b"".join(self.row_list)
+        checkpoint_chunk = b"".join(self.checkpoint_record_list)
+        self.row_list = []
+        self.row_bytes = 0
+        self.checkpoint_record_list = []
+
+        if self.executor is None:
+            try:
+                self.commit(chunk, checkpoint_chunk)
+            except Exception as e:
+                # the rows are gone from the buffer, so the job must fail rather than finish without them
+                self.exception = e
+                raise
+        else:
+            self.executor.submit(self.commit, chunk, checkpoint_chunk).add_done_callback(self.commit_done_callback)
+        return
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            self.file.close()
+            if self.checkpoint_file is not None:
+                self.checkpoint_file.close()
+                self.checkpoint_file = None
+        if self.exception is not None:
+            raise self.exception
+        return
+
+
+class ResponseCache:
+    # content-addressed responses in a sqlite file, least recently used entries are evicted above max_bytes
+    # mode "read_write" reads and writes, "read_only" never writes, "refresh" never reads and overwrites
+    # writes are buffered and committed in short transactions, so processes and jobs can share a cache file,
+    # waiting up to timeout seconds for each other's commits
+    def __init__(self, cache_file, max_bytes=1 << 30, mode="read_write", max_pending_writes=100, timeout=10):
+        assert mode in ("read_write", "read_only", "refresh")
+        self.cache_file = cache_file
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.max_pending_writes = max_pending_writes
+        self.timeout = timeout
+
+        self.connection = None
+        self.total_bytes = 0
+        self.pending_writes = 0
+        self.pending_put_dict = {}
+        self.touched_key_list = []
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+        return
+
+    def open(self):
+        # autocommit, transactions are explicit in commit()
+        self.connection = sqlite3.connect(self.cache_file, timeout=self.timeout, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS response"
+            " (key BLOB PRIMARY KEY, value BLOB NOT NULL, bytes INTEGER NOT NULL, access_time REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS response_access_time ON response (access_time)")
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM response").fetchone()[0]
+        return
+
+    def get_key(self, cache_key):
+        cache_key_bytes = json.dumps(cache_key, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(cache_key_bytes.encode("utf8")).digest()
+
+    def get(self, key):
+        if self.mode == "refresh":
+            return None
+        value = self.pending_put_dict.get(key)
+        if value is None:
+            row = self.connection.execute("SELECT value FROM response WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value = row[0]
+            if self.mode == "read_write":
+                self.touched_key_list.append(key)
+                self.add_pending_write()
+        self.hits += 1
+        return json.loads(value)
+
+    def put(self, key, value):
+        if self.mode == "read_only":
+            return
+        self.pending_put_dict[key] = json.dumps(value, ensure_ascii=False).encode("utf8")
+        self.puts += 1
+        self.add_pending_write()
+        return
+
+    def add_pending_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.max_pending_writes:
+            self.commit()
+        return
+
+    def evict(self):
+        # evict down to 90% of max_bytes so that eviction does not run on every put
+        # other processes sharing the file change its size, so start from the actual total
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM response").fetchone()[0]
+        target_bytes = self.max_bytes * 0.9
+        while self.total_bytes > target_bytes:
+            row_list = self.connection.execute(
+                "SELECT key, bytes FROM response ORDER BY access_time LIMIT 256"
+            ).fetchall()
+            if not row_list:
+                break
+            key_list = []
+            for key, entry_bytes in row_list:
+                key_list.append((key,))
+                self.total_bytes -= entry_bytes
+                if self.total_bytes <= target_bytes:
+                    break
+            self.connection.executemany("DELETE FROM response WHERE key = ?", key_list)
+            self.evictions += len(key_list)
+        return
+
+    def commit(self):
+        # one short write transaction, the lock is never held between commits
+        pending_put_dict = self.pending_put_dict
+        touched_key_list = self.touched_key_list
+        self.pending_put_dict = {}
+        self.touched_key_list = []
+        self.pending_writes = 0
+        if not pending_put_dict and not touched_key_list:
+            return
+
+        access_time = time.time()
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for key, value in pending_put_dict.items():
+                    old_row = self.connection.execute("SELECT bytes FROM response WHERE key = ?", (key,)).fetchone()
+                    if old_row is not None:
+                        self.total_bytes -= old_row[0]
+                    entry_bytes = len(key) + len(value)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO response (key, value, bytes, access_time) VALUES (?, ?, ?, ?)",
+                        (key, value, entry_bytes, access_time),
+                    )
+                    self.total_bytes += entry_bytes
+                if touched_key_list:
+                    self.connection.executemany(
+                        "UPDATE response SET access_time = ? WHERE key = ?",
+                        [(access_time, key) for key in touched_key_list],
+                    )
+                if self.total_bytes > self.max_bytes:
+                    self.evict()
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as e:
+            # e.g. another process held the lock past timeout, a cache can lose writes
+            logger.warning(f"[response cache] dropped {len(pending_put_dict):,} puts: {e}")
+        return
+
+    def load(self, task_datum):
+        # fill a task datum with its cached response, True on a hit
+        cache_key = task_datum.get_cache_key()
+        if cache_key is None:
+            return False
+        value = self.get(self.get_key(cache_key))
+        if value is None:
+            return False
+        task_datum.set_cache_value(value)
+        return True
+
+    def save(self, task_datum):
+        cache_key = task_datum.get_cache_key()
+        if cache_key is not None:
+            self.put(self.get_key(cache_key), task_datum.get_cache_value())
+        return
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+        self.connection = None
+        return
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "puts": self.puts,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+        }
+
+    def get_log_string(self):
+        stats = self.get_stats()
+        return (
+            f"[response cache] {stats['hit_rate']:.1%} hit rate, {stats['hits']:,} hits, {stats['misses']:,} misses,"
+            f" {stats['puts']:,} puts, {stats['evictions']:,} evictions, {stats['bytes']:,} bytes"
+        )
+
+
+class HTTPClient:
+    # a long-lived aiohttp session owned by a job, so raw HTTP runners reuse pooled keep-alive connections
+    # concurrent jobs that share a client share its session, which is closed when the last of them closes it
+    def __init__(
+            self, limit=100, limit_per_host=0, keepalive_timeout=30, ttl_dns_cache=300, ssl=None,
+            timeout=None,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.ssl = ssl
+        self.timeout = timeout
+
+        self.session = None
+        self.jobs = 0
+        return
+
+    async def open(self):
+        if self.session is not None:
+            self.jobs += 1
+            return
+        connector_kwargs = {}
+        if self.ssl is not None:
+            connector_kwargs["ssl"] = self.ssl
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.ttl_dns_cache,
+            **connector_kwargs,
+        )
+        session_kwargs = {}
+        if self.timeout is not None:
+            session_kwargs["timeout"] = aiohttp.ClientTimeout(total=self.timeout)
+        self.session = aiohttp.ClientSession(connector=connector, **session_kwargs)
+        self.jobs = 1
+        return
+
+    async def close(self):
+        self.jobs = max(0, self.jobs - 1)
+        if self.jobs == 0 and self.session is not None:
+            session = self.session
+            self.session = None
+            await session.close()
+        return
+
+
+def start_queue_logging(handler_list=None, level=logging.INFO):
+    # the event loop only enqueues log records of this module, a listener thread formats and writes them
+    # call stop() on the returned listener before exit to flush the queue
+    if handler_list is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(message)s", datefmt="%Y/%m/%d %H:%M:%S"))
+        handler_list = [handler]
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, *handler_list, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class LatencyHistogram:
+    # log-linear buckets in the manner of HDR histograms: sub_buckets per power of two above min_value
+    # a recorded value costs O(1) and a percentile is within 1 / sub_buckets of the true value
+    def __init__(self, min_value=0.001, sub_buckets=32, powers=40):
+        self.min_value = min_value
+        self.sub_buckets = sub_buckets
+        self.count_list = [0] * ((powers + 1) * sub_buckets)
+        self.count = 0
+        self.total = 0
+        self.max_value = 0
+        return
+
+    def record(self, value):
+        mantissa, exponent = math.frexp(value / self.min_value)
+        if exponent <= 0:
+            i = 0
+        else:
+            i = min(
+                len(self.count_list) - 1,
+                exponent * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets),
+            )
+        self.count_list[i] += 1
+        self.count += 1
+        self.total += value
+        self.max_value = max(self.max_value, value)
+        return
+
+    def get_bucket_upper_bound(self, i):
+        exponent, sub_bucket = divmod(i, self.sub_buckets)
+        if exponent == 0:
+            return self.min_value
+        return (0.5 + (sub_bucket + 1) / (2 * self.sub_buckets)) * 2 ** exponent * self.min_value
+
+    def get_percentile(self, percentile):
+        if self.count == 0:
+            return 0
+        rank = percentile / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.count_list):
+            seen += count
+            if count and seen >= rank:
+                return min(self.get_bucket_upper_bound(i), self.max_value)
+        return self.max_value
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.get_percentile(50),
+            "p90": self.get_percentile(90),
+            "p99": self.get_percentile(99),
+            "max": self.max_value,
+        }
+
+
+class CallbackMetricsSink:
+    def __init__(self, callback):
+        self.callback = callback
+        return
+
+    def emit(self, snapshot):
+        self.callback(snapshot)
+        return
+
+
+class LogMetricsSink:
+    # one summary line per report
+    def emit(self, snapshot):
+        latency = snapshot["latency"]
+        quota_string = "".join(
+            f", {name} {quota['utilization']:.0%}"
+            for name, quota in snapshot["quota"].items()
+        )
+        progress_string = ""
+        if snapshot["progress"] is not None:
+            progress_string = f", {snapshot['progress']:.1%} of input"
+        if snapshot["eta"] is not None:
+            progress_string += f", eta {datetime.timedelta(seconds=round(snapshot['eta']))}"
+        logger.info(
+            f"[metrics] {snapshot['done']:,} done, {snapshot['failed']:,} failed,"
+            f" {snapshot['in_flight']:,} in flight, {snapshot['todo']:,} todo, {snapshot['retry_waiting']:,} retrying,"
+            f" {snapshot['throughput']:.1f}/s,"
+            f" latency p50 {latency['p50']:.2f}s p99 {latency['p99']:.2f}s"
+            f"{quota_string}{progress_string}"
+        )
+        return
+
+
+class PrometheusMetricsSink:
+    # the latest snapshot in the Prometheus text format, e.g. for the node exporter textfile collector
+    def __init__(self, file, prefix="async_utils"):
+        self.file = file
+        self.prefix = prefix
+        return
+
+    def emit(self, snapshot):
+        line_list = []
+        for name, metric_type in (
+                ("runs", "counter"), ("successes", "counter"), ("errors", "counter"), ("retries", "counter"),
+                ("quits", "counter"), ("cache_hits", "counter"), ("done", "counter"), ("failed", "counter"),
+                ("used_tokens", "counter"), ("in_flight", "gauge"), ("todo", "gauge"), ("retry_waiting", "gauge"),
+                ("throughput", "gauge"),
+        ):
+            line_list.append(f"# TYPE {self.prefix}_{name} {metric_type}")
+            line_list.append(f"{self.prefix}_{name} {snapshot[name]}")
+        for name in ("progress", "eta"):
+            if snapshot[name] is not None:
+                line_list.append(f"# TYPE {self.prefix}_{name} gauge")
+                line_list.append(f"{self.prefix}_{name} {snapshot[name]}")
+
+        latency = snapshot["latency"]
+        line_list.append(f"# TYPE {self.prefix}_latency_seconds summary")
+        for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99")):
+            line_list.append(f'{self.prefix}_latency_seconds{{quantile="{quantile}"}} {latency[key]}')
+        line_list.append(f"{self.prefix}_latency_seconds_sum {latency['mean'] * latency['count']}")
+        line_list.append(f"{self.prefix}_latency_seconds_count {latency['count']}")
+
+        for key in ("used", "limit", "utilization"):
+            line_list.append(f"# TYPE {self.prefix}_quota_{key} gauge")
+            for name, quota in snapshot["quota"].items():
+                line_list.append(f'{self.prefix}_quota_{key}{{quota="{name}"}} {quota[key]}')
+
+        tmp_file = self.file + ".tmp"
+        with open(tmp_file, "w", encoding="utf8") as f:
+            f.write("\n".join(line_list) + "\n")
+        os.replace(tmp_file, self.file)
+        return
+
+
+class MetricsCollector:
+    # counters, queue depths, run latency, and quota usage of a job, emitted to every sink each interval and at the end
+    def __init__(self, sink_list=None, interval=10):
+        self.sink_list = [LogMetricsSink()] if sink_list is None else sink_list
+        self.interval = interval
+
+        self.quota_manager = None
+        self.input_reader = None
+        self.timer = None
+        self.start_time = 0
+        self.report_time = 0
+        self.report_done = 0
+
+        self.runs = 0
+        self.successes = 0
+        self.errors = 0
+        self.retries = 0
+        self.quits = 0
+        self.cache_hits = 0
+        self.done = 0
+        self.failed = 0
+        self.used_tokens = 0
+        self.todo = 0
+        self.in_flight = 0
+        self.retry_waiting = 0
+        self.latency = LatencyHistogram()
+        return
+
+    def open(self, quota_manager, input_reader=None):
+        self.quota_manager = quota_manager
+        self.input_reader = input_reader
+        self.start_time = self.report_time = time.time()
+        if self.interval:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.report)
+        return
+
+    def record_run(self):
+        self.runs += 1
+        return
+
+    def record_run_done(self, task_datum, outcome):
+        # outcome: "success", "retry", or "quit"
+        self.latency.record(max(0, task_datum.end_time - task_datum.start_time))
+        if outcome == "success":
+            self.successes += 1
+            self.used_tokens += task_datum.get_used_tokens() or 0
+        else:
+            self.errors += 1
+            if outcome == "retry":
+                self.retries += 1
+            else:
+                self.quits += 1
+        return
+
+    def record_cache_hit(self):
+        self.cache_hits += 1
+        return
+
+    def record_finished(self, task_datum):
+        # a task that will not run again
+        if task_datum.run_failed:
+            self.failed += 1
+        else:
+            self.done += 1
+        return
+
+    def set_queue_depth(self, todo, in_flight, retry_waiting):
+        self.todo = todo
+        self.in_flight = in_flight
+        self.retry_waiting = retry_waiting
+        return
+
+    def get_snapshot(self):
+        now = time.time()
+        quota = {}
+        if self.quota_manager is not None:
+            for name, (used, limit) in self.quota_manager.get_usage().items():
+                quota[name] = {"used": used, "limit": limit, "utilization": used / limit if limit else 0}
+
+        # progress: the input handed out, discounted by the share of handed out tasks not yet finished
+        # the estimated time left assumes the rest of the input runs at the average pace so far
+        progress = None if self.input_reader is None else self.input_reader.get_progress()
+        eta = None
+        if progress is not None:
+            finished = self.done + self.failed
+            pending = self.todo + self.in_flight + self.retry_waiting
+            progress *= finished / max(1, finished + pending)
+            if progress > 0:
+                eta = (now - self.start_time) * (1 - progress) / progress
+        return {
+            "time": now,
+            "elapsed": now - self.start_time,
+            "runs": self.runs,
+            "successes": self.successes,
+            "errors": self.errors,
+            "retries": self.retries,
+            "quits": self.quits,
+            "cache_hits": self.cache_hits,
+            "done": self.done,
+            "failed": self.failed,
+            "used_tokens": self.used_tokens,
+            "todo": self.todo,
+            "in_flight": self.in_flight,
+            "retry_waiting": self.retry_waiting,
+            "throughput": (self.done - self.report_done) / max(now - self.report_time, 1e-9),
+            "latency": self.latency.get_stats(),
+            "quota": quota,
+            "progress": progress,
+            "eta": eta,
+        }
+
+    def report(self):
+        snapshot = self.get_snapshot()
+        self.report_time = snapshot["time"]
+        self.report_done = self.done
+        for sink in self.sink_list:
+            sink.emit(snapshot)
+        if self.timer is not None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.report)
+        return
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.report()
+        return
+
+
+async def wait_for_event(event, timeout=None):
+    if timeout is None:
+        await event.wait()
+    else:
+        timer = asyncio.get_running_loop().call_later(timeout, event.set)
+        try:
+            await event.wait()
+        finally:
+            timer.cancel()
+    event.clear()
+    return
+
+
+async def iterate_batch_data(
+        data_iterable, task_datum_class, task_runner, quota_manager,
+        max_task_runs=1, sleep_interval=0.001, retry_policy=None, packer=None, response_cache=None,
+        completed_task_id_set=None, metrics=None, task_log_every=1,
 ):
-    # input file
-    fr = open(input_file, "r", encoding="utf8")
-    input_task_id = 0
-    no_more_input = False
+    # run a task for every data dict of an iterable, an async iterable, or an input reader
+    # yield each task datum once it will not run again, i.e. it has succeeded or run_failed is set
+    # close the generator, e.g. with contextlib.aclosing, when not iterating to the end
+    # task_log_every: log the lines of every task (1), of about one in every n tasks (n), or of none (0)
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    if isinstance(data_iterable, InputReader):
+        input_reader = data_iterable
+    else:
+        input_reader = IterableInputReader(data_iterable)
+    if completed_task_id_set is None:
+        completed_task_id_set = set()
+    if not logger.isEnabledFor(logging.INFO):
+        task_log_every = 0
+    elif task_log_every != 1 and metrics is None:
+        # a periodic progress line in place of per-task lines, only when it would be logged
+        metrics = MetricsCollector()
+
+    def log_task(tag, task_datum):
+        if task_log_every and (task_log_every == 1 or hash(task_datum.task_id) % task_log_every == 0):
+            logger.info(f"{tag} {task_datum.get_log_string()}")
+        return
 
-    # tasks
+    # tasks, done runs are kept as compact quota records for as long as the quota manager needs them
+    uses_done_queue = getattr(quota_manager, "uses_done_queue", True)
     todo_task_datum_queue = deque()
     running_task_to_datum = {}
+    done_task_queue = deque()
     done_task_datum_queue = []
     done_task_datum_queue_next_id = 0
+    retry_task_datum_queue = []
+    retry_task_datum_queue_next_id = 0
+    finished_task_datum_list = []
 
-    # output file
-    completed_task_id_set = set()
-    if not ignore_and_rewrite_output_file and os.path.exists(output_file):
-        with open(output_file, "r", encoding="utf8") as f:
-            for line in f:
-                datum = json.loads(line)
-                completed_task_id_set.add(datum["task_id"])
+    # events: the loop only wakes up when a task completes, input is ready, or when polling for quota
+    wakeup_event = asyncio.Event()
 
-    output_mode = "w" if ignore_and_rewrite_output_file else "a"
-    fw = open(output_file, output_mode, encoding="utf8")
+    def task_done_callback(task):
+        done_task_queue.append(task)
+        wakeup_event.set()
+        return
 
-    # loop
-    while True:
-        await asyncio.sleep(sleep_interval)
+    def close_response_cache():
+        response_cache.close()
+        logger.info(response_cache.get_log_string())
+        return
 
-        # step 1: loop through running tasks: check and process their completion
-        new_running_task_to_datum = {}
+    # job resources, each closed in the finally below only if it was opened, in reverse order
+    exit_stack = contextlib.AsyncExitStack()
+
+    # loop
+    try:
+        if response_cache is not None:
+            response_cache.open()
+            exit_stack.callback(close_response_cache)
+        if metrics is not None:
+            metrics.open(quota_manager, input_reader)
+            exit_stack.callback(metrics.close)
+        await task_datum_class.start_job(completed_task_id_set)
+        exit_stack.push_async_callback(task_datum_class.end_job)
+        # closing is safe after a partial open, e.g. of a missing input file
+        exit_stack.callback(input_reader.close)
+        input_reader.open(task_datum_class, wakeup_event)
+
+        while True:
+            # step 1: process completed tasks
+            while done_task_queue:
+                running_task = done_task_queue.popleft()
+                running_task_datum = running_task_to_datum.pop(running_task)
 
-        for running_task, running_task_datum in running_task_to_datum.items():
-            if running_task.done():
                 try:
                     _ = running_task.result()
-                    successful = True
-                except:
-                    successful = False
-
-                if successful:
-                    running_task_datum.finish()
-                    logger.info(f"[success] {running_task_datum.get_log_string()}")
-                    json.dump(running_task_datum.get_json_obj(), fw, ensure_ascii=False)
-                    fw.write("\n")
-                    fw.flush()
+                    exception = None
+                except BaseException as e:
+                    exception = e
+                    running_task_datum.response_headers = get_exception_headers(e)
+                running_task_datum.run_failed = exception is not None
+                running_task_datum.error_status = None if exception is None else get_exception_status(exception)
+
+                if exception is None:
+                    log_task("[success]", running_task_datum)
+                    if metrics is not None:
+                        metrics.record_run_done(running_task_datum, "success")
+                    if response_cache is not None:
+                        response_cache.save(running_task_datum)
+                    if packer is None:
+                        running_task_datum.finish()
+                        finished_task_datum_list.append(running_task_datum)
+                    else:
+                        packer.scatter(running_task_datum)
                 else:
                     running_task_datum.end_time = time.time()
-                    if running_task_datum.run_id < max_task_runs:
-                        logger.info(f"[error] {running_task_datum.get_log_string()}")
-                        todo_task_datum_queue.append(running_task_datum)
+                    retry_type = retry_policy.classify_exception(exception)
+                    if retry_type == "throttled":
+                        running_task_datum.throttled_runs += 1
+
+                    if retry_policy.has_retry(running_task_datum, retry_type, max_task_runs):
+                        log_task("[error]", running_task_datum)
+                        if metrics is not None:
+                            metrics.record_run_done(running_task_datum, "retry")
+                        retry_time = time.time() + retry_policy.get_retry_delay(running_task_datum, exception)
+                        heapq.heappush(
+                            retry_task_datum_queue,
+                            (retry_time, retry_task_datum_queue_next_id, running_task_datum),
+                        )
+                        retry_task_datum_queue_next_id += 1
                     else:
-                        logger.info(f"[error] [quit] {running_task_datum.get_log_string()}")
-
-                heapq.heappush(
-                    done_task_datum_queue,
-                    (
-                        running_task_datum.end_time,
-                        done_task_datum_queue_next_id,
-                        running_task_datum,
-                    ),
-                )
-                done_task_datum_queue_next_id += 1
-            else:
-                new_running_task_to_datum[running_task] = running_task_datum
-
-        running_task_to_datum = new_running_task_to_datum
-
-        # step 2: loop through done tasks: reclaim quota
-        quota_manager.reclaim_quota(done_task_datum_queue)
-
-        # step 3: read more task datum from input file
-        if not todo_task_datum_queue and not no_more_input:
+                        log_task("[error] [quit]", running_task_datum)
+                        if metrics is not None:
+                            metrics.record_run_done(running_task_datum, "quit")
+                        if packer is None:
+                            finished_task_datum_list.append(running_task_datum)
+                        else:
+                            for dropped_row_task_datum in packer.drop(running_task_datum):
+                                log_task("[error] [quit]", dropped_row_task_datum)
+                                dropped_row_task_datum.run_failed = True
+                                dropped_row_task_datum.error_status = running_task_datum.error_status
+                                finished_task_datum_list.append(dropped_row_task_datum)
+                exception = None
+
+                quota_manager.settle_quota(running_task_datum)
+                if uses_done_queue:
+                    heapq.heappush(
+                        done_task_datum_queue,
+                        (
+                            running_task_datum.end_time,
+                            done_task_datum_queue_next_id,
+                            QuotaRecord(running_task_datum),
+                        ),
+                    )
+                    done_task_datum_queue_next_id += 1
+
+            # step 2: loop through done tasks: reclaim quota
+            quota_manager.reclaim_quota(done_task_datum_queue)
+
+            # step 3: move failed tasks whose backoff has passed to the todo queue
+            while retry_task_datum_queue and retry_task_datum_queue[0][0] <= time.time():
+                _retry_time, _retry_task_datum_queue_id, retry_task_datum = heapq.heappop(retry_task_datum_queue)
+                todo_task_datum_queue.append(retry_task_datum)
+
+            # step 4: run as many tasks as quota allows, taking task datum from the input reader when needed
             while True:
-                line = fr.readline()
-                if not line:
-                    no_more_input = True
+                if not todo_task_datum_queue:
+                    if packer is None:
+                        input_item = input_reader.get()
+                        if input_item is None:
+                            break
+                        input_task_id, line_data = input_item
+                        input_task_datum = task_datum_class(input_task_id, line_data)
+                    else:
+                        input_task_datum = packer.get(input_reader, task_datum_class)
+                        if input_task_datum is None:
+                            break
+
+                    # a cached response completes the task without a run, bypassing the quota manager
+                    if response_cache is not None and response_cache.load(input_task_datum):
+                        input_task_datum.start_time = input_task_datum.end_time = time.time()
+                        log_task("[cache]", input_task_datum)
+                        if metrics is not None:
+                            metrics.record_cache_hit()
+                        if packer is None:
+                            input_task_datum.finish()
+                            finished_task_datum_list.append(input_task_datum)
+                        else:
+                            packer.scatter(input_task_datum)
+                        continue
+                    todo_task_datum_queue.append(input_task_datum)
+
+                if not quota_manager.has_enough_quota(todo_task_datum_queue[0]):
                     break
-                input_task_id += 1
-                if start_id is not None and input_task_id < start_id:
-                    continue
-                if end_id is not None and input_task_id > end_id:
-                    no_more_input = True
+
+                init_task_datum = todo_task_datum_queue.popleft()
+                init_task_datum.run_id += 1
+                quota_manager.deduct_quota(init_task_datum)
+                init_task = asyncio.create_task(task_runner(init_task_datum))
+                init_task.add_done_callback(task_done_callback)
+                running_task_to_datum[init_task] = init_task_datum
+                log_task("[run]", init_task_datum)
+                if metrics is not None:
+                    metrics.record_run()
+
+            # step 5: finish rows whose vectors have all returned from packed requests
+            if packer is not None:
+                for done_row_task_datum in packer.get_done_row_list():
+                    done_row_task_datum.finish()
+                    log_task("[success]", done_row_task_datum)
+                    finished_task_datum_list.append(done_row_task_datum)
+
+            # step 6: hand finished task datums to the caller
+            if metrics is not None:
+                metrics.set_queue_depth(
+                    len(todo_task_datum_queue), len(running_task_to_datum), len(retry_task_datum_queue),
+                )
+                for finished_task_datum in finished_task_datum_list:
+                    metrics.record_finished(finished_task_datum)
+            if finished_task_datum_list:
+                yield_task_datum_list = finished_task_datum_list
+                finished_task_datum_list = []
+                for finished_task_datum in yield_task_datum_list:
+                    yield finished_task_datum
+
+            # step 7: end if there is no running tasks, no todo tasks, no tasks waiting to retry, and no more input
+            if not todo_task_datum_queue and not running_task_to_datum and not retry_task_datum_queue:
+                if input_reader.is_done():
                     break
-                if input_task_id in completed_task_id_set:
-                    continue
-                line_data = json.loads(line)
-                input_task_datum = task_datum_class(input_task_id, line_data)
-                todo_task_datum_queue.append(input_task_datum)
-                break
 
-        # step 4: end if there is no running tasks and no todo tasks
-        if not todo_task_datum_queue:
-            if running_task_to_datum:
+            # step 8: wait for task completion, quota for the next todo task, or the next retry
+            if done_task_queue:
                 continue
-            else:
-                break
+            wakeup_time = None
+            if todo_task_datum_queue:
+                quota_time = quota_manager.get_quota_available_time(
+                    todo_task_datum_queue[0], done_task_datum_queue,
+                )
+                if quota_time is not None:
+                    wakeup_time = quota_time
+                elif not running_task_to_datum:
+                    # the quota manager cannot tell when quota frees up, poll
+                    wakeup_time = time.time() + sleep_interval
+            if retry_task_datum_queue:
+                retry_time = retry_task_datum_queue[0][0]
+                wakeup_time = retry_time if wakeup_time is None else min(wakeup_time, retry_time)
+            timeout = None if wakeup_time is None else max(0, wakeup_time - time.time())
+            await wait_for_event(wakeup_event, timeout)
+    finally:
+        # on an exception, cancel running tasks so that nothing still uses the resources closed below
+        for running_task in running_task_to_datum:
+            running_task.cancel()
+        if running_task_to_datum:
+            await asyncio.gather(*running_task_to_datum, return_exceptions=True)
+
+        if packer is not None:
+            logger.info(packer.get_log_string())
+        await exit_stack.aclose()
+    return
+
+
+async def process_batch_data(
+        input_file, output_file, task_datum_class, task_runner, quota_manager,
+        max_task_runs=1, start_id=None, end_id=None, ignore_and_rewrite_output_file=False,
+        sleep_interval=0.001, retry_policy=None, output_writer=None, use_input_index=False,
+        input_reader=None, packer=None, response_cache=None, skip_task_id_set=None, metrics=None,
+        task_log_every=1,
+):
+    if output_writer is None:
+        output_writer = OutputWriter()
+    if input_reader is None:
+        input_reader = InputReader()
+
+    # output file
+    completed_task_id_set = set()
+    if not ignore_and_rewrite_output_file and os.path.exists(output_file):
+        truncated_bytes = truncate_partial_line(output_file)
+        if truncated_bytes:
+            logger.info(f"truncated a partial line of {truncated_bytes:,} bytes at the end of {output_file}")
+        completed_task_id_set = load_completed_task_id_set(output_file)
+    if skip_task_id_set:
+        # tasks completed elsewhere, e.g. in the merged output of a multi-process run
+        completed_task_id_set |= skip_task_id_set
+
+    output_mode = "w" if ignore_and_rewrite_output_file else "a"
+    output_writer.open(output_file, output_mode, before_commit=task_datum_class.flush_job)
 
-        # step 5: run next task
-        if quota_manager.has_enough_quota(todo_task_datum_queue[0]):
-            init_task_datum = todo_task_datum_queue.popleft()
-            init_task_datum.run_id += 1
-            quota_manager.deduct_quota(init_task_datum)
-            init_task = asyncio.create_task(task_runner(init_task_datum))
-            running_task_to_datum[init_task] = init_task_datum
-            logger.info(f"[run] {init_task_datum.get_log_string()}")
-
-    fr.close()
-    fw.close()
+    # input file
+    input_reader.set_input_file(input_file, start_id, end_id, completed_task_id_set, use_input_index)
+
+    # loop
+    task_datum_iterator = iterate_batch_data(
+        input_reader, task_datum_class, task_runner, quota_manager,
+        max_task_runs=max_task_runs, sleep_interval=sleep_interval, retry_policy=retry_policy,
+        packer=packer, response_cache=response_cache, completed_task_id_set=completed_task_id_set,
+        metrics=metrics, task_log_every=task_log_every,
+    )
+    try:
+        async with contextlib.aclosing(task_datum_iterator):
+            async for task_datum in task_datum_iterator:
+                if not task_datum.run_failed:
+                    output_writer.write_row(task_datum.task_id, task_datum.get_json_bytes(output_writer.json_codec))
+                task_datum.release()
+    finally:
+        output_writer.close()
     logger.info("done")
     return
 
 
+def get_shard_output_file(output_file, shard):
+    return f"{output_file}.shard{shard}"
+
+
+def merge_output_files(output_file, shard_output_file_list):
+    # append rows of shard output files to output_file, skipping rows already there so a crash mid-merge is harmless
+    completed_task_id_set = load_completed_task_id_set(output_file) if os.path.exists(output_file) else set()
+    with open(output_file, "ab") as fw:
+        for shard_output_file in shard_output_file_list:
+            if not os.path.exists(shard_output_file):
+                continue
+            truncate_partial_line(shard_output_file)
+            with open(shard_output_file, "rb") as fr:
+                for line in fr:
+                    task_id = extract_task_id(line)
+                    if task_id not in completed_task_id_set:
+                        completed_task_id_set.add(task_id)
+                        fw.write(line)
+    for shard_output_file in shard_output_file_list:
+        for file in (shard_output_file, get_checkpoint_file(shard_output_file)):
+            if os.path.exists(file):
+                os.remove(file)
+
+    # bring the checkpoint of the merged file up to date, so the next resume does not scan the merged rows
+    return load_completed_task_id_set(output_file) if os.path.exists(output_file) else set()
+
+
+class ProcessQuotaManager:
+    # a worker process's share of a quota manager, 1 / the number of active workers
+    # a finished worker's share is handed over after its last requests leave the 60-second window
+    def __init__(self, quota_manager, finish_time_array):
+        self.quota_manager = quota_manager
+        self.uses_done_queue = getattr(quota_manager, "uses_done_queue", True)
+        self.finish_time_array = finish_time_array
+        self.workers = 0
+        self.update_time = 0
+        self.next_update_time = None
+        self.update_share()
+        return
+
+    def update_share(self):
+        now = time.time()
+        workers = 0
+        self.next_update_time = None
+        for finish_time in self.finish_time_array:
+            if finish_time == 0 or now < finish_time + 60:
+                workers += 1
+            if finish_time != 0 and now < finish_time + 60:
+                if self.next_update_time is None or finish_time + 60 < self.next_update_time:
+                    self.next_update_time = finish_time + 60
+        if workers != self.workers:
+            self.workers = workers
+            self.quota_manager.set_quota_share(1 / workers)
+        self.update_time = now
+        return
+
+    def has_enough_quota(self, init_task_datum):
+        return self.quota_manager.has_enough_quota(init_task_datum)
+
+    def reclaim_quota(self, done_task_datum_queue):
+        if time.time() >= self.update_time + 1:
+            self.update_share()
+        self.quota_manager.reclaim_quota(done_task_datum_queue)
+        return
+
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        quota_time = self.quota_manager.get_quota_available_time(init_task_datum, done_task_datum_queue)
+        if self.next_update_time is not None and (quota_time is None or self.next_update_time < quota_time):
+            return self.next_update_time
+        return quota_time
+
+    def deduct_quota(self, init_task_datum):
+        self.quota_manager.deduct_quota(init_task_datum)
+        return
+
+    def settle_quota(self, done_task_datum):
+        self.quota_manager.settle_quota(done_task_datum)
+        return
+
+    def get_headroom(self):
+        return self.quota_manager.get_headroom()
+
+    def get_usage(self):
+        return self.quota_manager.get_usage()
+
+
+def run_process_batch_data_worker(worker_id, setup, finish_time_array, kwargs):
+    try:
+        if setup is not None:
+            setup(worker_id)
+        kwargs["quota_manager"] = ProcessQuotaManager(kwargs["quota_manager"], finish_time_array)
+        asyncio.run(process_batch_data(**kwargs))
+    finally:
+        finish_time_array[worker_id] = time.time()
+    return
+
+
+def process_batch_data_in_processes(
+        input_file, output_file, task_datum_class, task_runner, quota_manager,
+        processes=2, start_id=None, end_id=None, ignore_and_rewrite_output_file=False, setup=None,
+        **kwargs,
+):
+    # run process_batch_data on byte-balanced shards of the input in worker processes that share the quota,
+    # then merge the shard outputs into output_file
+    # workers inherit class attributes with the fork start method, otherwise configure them in setup(worker_id)
+    # class-level sinks such as emb_store or bytes_file must be opened per worker in setup(worker_id)
+    shard_pattern = re.compile(re.escape(os.path.basename(output_file)) + r"\.shard\d+")
+    output_dir = os.path.dirname(output_file) or "."
+    old_shard_output_file_list = sorted(
+        os.path.join(os.path.dirname(output_file), name)
+        for name in os.listdir(output_dir)
+        if shard_pattern.fullmatch(name)
+    )
+
+    if ignore_and_rewrite_output_file:
+        for file in [output_file, get_checkpoint_file(output_file)] + old_shard_output_file_list:
+            if os.path.exists(file):
+                os.remove(file)
+        completed_task_id_set = set()
+    else:
+        # rows left in shard outputs by an interrupted run are completed tasks too
+        completed_task_id_set = merge_output_files(output_file, old_shard_output_file_list)
+
+    range_list = split_input_file(input_file, processes, start_id=start_id, end_id=end_id)
+    shard_output_file_list = [get_shard_output_file(output_file, shard) for shard in range(len(range_list))]
+
+    context = multiprocessing.get_context()
+    finish_time_array = context.Array("d", len(range_list), lock=False)
+    process_list = []
+    for worker_id, (shard_start_id, shard_end_id) in enumerate(range_list):
+        worker_kwargs = dict(
+            kwargs,
+            input_file=input_file,
+            output_file=shard_output_file_list[worker_id],
+            task_datum_class=task_datum_class,
+            task_runner=task_runner,
+            quota_manager=quota_manager,
+            start_id=shard_start_id,
+            end_id=shard_end_id,
+            ignore_and_rewrite_output_file=True,
+            use_input_index=True,
+            skip_task_id_set={
+                task_id
+                for task_id in completed_task_id_set
+                if shard_start_id <= task_id <= shard_end_id
+            },
+        )
+        process = context.Process(
+            target=run_process_batch_data_worker,
+            args=(worker_id, setup, finish_time_array, worker_kwargs),
+            name=f"process_batch_data_{worker_id}",
+        )
+        process.start()
+        process_list.append(process)
+        logger.info(f"[process] worker#{worker_id} pid#{process.pid} tasks {shard_start_id:,}-{shard_end_id:,}")
+
+    for process in process_list:
+        process.join()
+
+    completed_task_id_set = merge_output_files(output_file, shard_output_file_list)
+    logger.info(f"[process] merged {len(completed_task_id_set):,} completed tasks into {output_file}")
+
+    failed_worker_list = [
+        worker_id
+        for worker_id, process in enumerate(process_list)
+        if process.exitcode != 0
+    ]
+    if failed_worker_list:
+        raise RuntimeError(f"worker processes {failed_worker_list} failed, rerun to resume their tasks")
+    return
+
+
 """
 math
 """
@@ -212,67 +2263,388 @@ OpenAI
 """
 
 
+TOKENIZER_THREADS = min(8, os.cpu_count() or 1)
+
+
+def encode_token_counts(tokenizer, text_list):
+    # batched so that tiktoken encodes texts in parallel without holding the GIL
+    if len(text_list) == 1 or TOKENIZER_THREADS == 1:
+        return [len(tokenizer.encode(text)) for text in text_list]
+    return [len(tokens) for tokens in tokenizer.encode_batch(text_list, num_threads=TOKENIZER_THREADS)]
+
+
+class TokenCountCache:
+    # bounded LRU of token counts keyed by a digest of (encoding name, text), shareable across datum classes
+    # an entry costs about 160 bytes: a 16-byte digest key, an int, and the OrderedDict node
+    entry_bytes = 160
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_entries = max(1, max_bytes // self.entry_bytes)
+        self.key_to_tokens = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def count_tokens(self, tokenizer, text_list):
+        prefix = tokenizer.name.encode("utf8") + b"\0"
+        key_list = [
+            hashlib.blake2b(prefix + text.encode("utf8"), digest_size=16).digest()
+            for text in text_list
+        ]
+
+        tokens_list = [None] * len(text_list)
+        miss_index_list = []
+        with self.lock:
+            for i, key in enumerate(key_list):
+                tokens = self.key_to_tokens.get(key)
+                if tokens is None:
+                    miss_index_list.append(i)
+                else:
+                    self.key_to_tokens.move_to_end(key)
+                    tokens_list[i] = tokens
+
+        # encode each distinct missing text once, repeats within the batch count as hits
+        miss_key_to_text = {key_list[i]: text_list[i] for i in miss_index_list}
+        with self.lock:
+            self.hits += len(text_list) - len(miss_key_to_text)
+            self.misses += len(miss_key_to_text)
+
+        if miss_index_list:
+            miss_key_list = list(miss_key_to_text)
+            miss_tokens_list = encode_token_counts(tokenizer, list(miss_key_to_text.values()))
+            miss_key_to_tokens = dict(zip(miss_key_list, miss_tokens_list))
+            for i in miss_index_list:
+                tokens_list[i] = miss_key_to_tokens[key_list[i]]
+
+            with self.lock:
+                for key, tokens in miss_key_to_tokens.items():
+                    self.key_to_tokens[key] = tokens
+                    self.key_to_tokens.move_to_end(key)
+                while len(self.key_to_tokens) > self.max_entries:
+                    self.key_to_tokens.popitem(last=False)
+        return tokens_list
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.key_to_tokens),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+            }
+
+    def get_log_string(self):
+        stats = self.get_stats()
+        return (
+            f"[token cache] {stats['hit_rate']:.1%} hit rate,"
+            f" {stats['hits']:,} hits, {stats['misses']:,} misses, {stats['entries']:,} entries"
+        )
+
+
+def count_tokens(tokenizer, text_list, token_cache=None):
+    # token count of every text
+    if token_cache is not None:
+        return token_cache.count_tokens(tokenizer, text_list)
+    return encode_token_counts(tokenizer, text_list)
+
+
 class OpenAITaskDatum(BasicTaskDatum):
+    read_fields = ("text_in", "model", "choices", "max_tokens", "in_tokens")
     tokenizer = None
+    token_cache = None
     client = None
+    default_max_tokens = None
 
     def __init__(self, task_id, data):
         super().__init__(task_id, data)
 
-        self.data["in_tokens"] = len(self.tokenizer.encode(self.data["text_in"]))
+        if "in_tokens" not in self.data:
+            self.data["in_tokens"] = count_tokens(self.tokenizer, [self.data["text_in"]], self.token_cache)[0]
         self.data["text_out_list"] = []
         return
 
+    @classmethod
+    def prepare_data_list(cls, data_list):
+        in_tokens_list = count_tokens(cls.tokenizer, [data["text_in"] for data in data_list], cls.token_cache)
+        for data, in_tokens in zip(data_list, in_tokens_list):
+            data["in_tokens"] = in_tokens
+        return
+
+    @classmethod
+    async def end_job(cls):
+        if cls.token_cache is not None:
+            logger.info(cls.token_cache.get_log_string())
+        return
+
     def set_out_tokens(self):
-        self.data["out_tokens"] = sum(
-            len(self.tokenizer.encode(text_out))
-            for text_out in self.data["text_out_list"]
-        )
+        self.data["out_tokens"] = sum(count_tokens(self.tokenizer, self.data["text_out_list"], self.token_cache)) \
+            if self.data["text_out_list"] else 0
         return
 
+    def get_max_tokens(self):
+        # the output cap of every choice, sent with the request and reserved against the quota
+        max_tokens = self.data.get("max_tokens")
+        if max_tokens is None:
+            max_tokens = self.default_max_tokens
+        return max_tokens
+
+    def get_request_kwargs(self):
+        kwargs = {
+            "model": self.data["model"],
+            "n": self.data["choices"],
+            "messages": [
+                {"role": "user", "content": self.data["text_in"]},
+            ],
+        }
+        max_tokens = self.get_max_tokens()
+        if max_tokens is not None:
+            kwargs["max_completion_tokens"] = max_tokens
+        return kwargs
+
+    def get_cache_key(self):
+        return {"provider": "openai", **self.get_request_kwargs()}
+
+    def get_cache_value(self):
+        return {"text_out_list": self.data["text_out_list"], "out_tokens": self.data.get("out_tokens")}
+
+    def set_cache_value(self, value):
+        self.data["text_out_list"] = value["text_out_list"]
+        if value.get("out_tokens") is None:
+            self.set_out_tokens()
+        else:
+            self.data["out_tokens"] = value["out_tokens"]
+        return
+
+    def get_estimated_tokens(self):
+        # prompt plus the requested max output of every choice, guess output ~ prompt if unspecified
+        max_tokens = self.get_max_tokens()
+        if max_tokens is None:
+            max_tokens = self.data["in_tokens"]
+        return self.data["in_tokens"] + self.data["choices"] * max_tokens
+
+    def get_used_tokens(self):
+        if self.data.get("usage_tokens") is not None:
+            return self.data["usage_tokens"]
+        if "out_tokens" in self.data:
+            return self.data["in_tokens"] + self.data["out_tokens"]
+        return None
+
 
 class OpenAIQuotaManager(BasicQuotaManager):
     def __init__(self, rpm, tpm):
         super().__init__()
         self.rpm = rpm
         self.tpm = tpm
+        self.rpm_limit = rpm
+        self.tpm_limit = tpm
+
+        # limits of the whole quota, rpm_limit and tpm_limit are this manager's share of them
+        self.total_rpm_limit = rpm
+        self.total_tpm_limit = tpm
+
+        # requests and tokens of done runs in the 60-second window, i.e. what the window gives back as it expires
+        self.window_requests = 0
+        self.window_tokens = 0
+
+        # the last quota available time, valid while the heap head, the quota, and the reservation are unchanged
+        self.quota_time_key = None
+        self.quota_time = None
+        return
+
+    def set_limit(self, rpm_limit, tpm_limit):
+        if rpm_limit is not None:
+            self.total_rpm_limit = rpm_limit
+            rpm_limit = get_quota_share(rpm_limit, self.quota_share)
+            self.rpm += rpm_limit - self.rpm_limit
+            self.rpm_limit = rpm_limit
+        if tpm_limit is not None:
+            self.total_tpm_limit = tpm_limit
+            tpm_limit = get_quota_share(tpm_limit, self.quota_share)
+            self.tpm += tpm_limit - self.tpm_limit
+            self.tpm_limit = tpm_limit
+        return
+
+    def set_quota_share(self, quota_share):
+        self.quota_share = quota_share
+        self.set_limit(self.total_rpm_limit, self.total_tpm_limit)
         return
 
+    def get_reserved_tokens(self, init_task_datum):
+        # a request estimated above the whole budget can still run once the window is empty
+        return min(init_task_datum.get_estimated_tokens(), self.tpm_limit)
+
+    def get_headroom(self):
+        return min(self.rpm / self.rpm_limit, self.tpm / self.tpm_limit)
+
+    def get_usage(self):
+        return {
+            "requests": (self.rpm_limit - self.rpm, self.rpm_limit),
+            "tokens": (self.tpm_limit - self.tpm, self.tpm_limit),
+        }
+
     def has_enough_quota(self, init_task_datum):
-        return self.rpm > 0 and self.tpm > init_task_datum.data["in_tokens"] * 2
+        return self.rpm > 0 and self.tpm >= self.get_reserved_tokens(init_task_datum)
 
     def reclaim_quota(self, done_task_datum_queue):
         while done_task_datum_queue:
-            end_time, _done_task_datum_queue_id, done_task_datum = done_task_datum_queue[0]
+            end_time, _done_task_datum_queue_id, quota_record = done_task_datum_queue[0]
             if end_time >= time.time() - 60:
                 break
             heapq.heappop(done_task_datum_queue)
             self.rpm += 1
-            self.tpm += done_task_datum.data["in_tokens"]
+            self.tpm += quota_record.quota_tokens
+            self.window_requests -= 1
+            self.window_tokens -= quota_record.quota_tokens
         return
 
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        reserved_tokens = self.get_reserved_tokens(init_task_datum)
+        if self.rpm > 0 and self.tpm >= reserved_tokens:
+            return time.time()
+
+        # quota held by running tasks, not even the whole window expiring would suffice
+        if self.rpm + self.window_requests <= 0 or self.tpm + self.window_tokens < reserved_tokens:
+            return None
+
+        # runs end in about the order they enter the heap, so new runs do not change the expiry that suffices
+        key = (done_task_datum_queue[0][2] if done_task_datum_queue else None, self.rpm, self.tpm, reserved_tokens)
+        if key == self.quota_time_key:
+            return self.quota_time
+
+        # walk the 60-second window in expiry order until both requests and tokens suffice
+        quota_time = None
+        rpm = self.rpm
+        tpm = self.tpm
+        for end_time, _done_task_datum_queue_id, quota_record in iterate_heap_in_order(done_task_datum_queue):
+            rpm += 1
+            tpm += quota_record.quota_tokens
+            if rpm > 0 and tpm >= reserved_tokens:
+                quota_time = end_time + 60
+                break
+        self.quota_time_key = key
+        self.quota_time = quota_time
+        return quota_time
+
     def deduct_quota(self, init_task_datum):
+        init_task_datum.quota_tokens = self.get_reserved_tokens(init_task_datum)
         self.rpm -= 1
-        self.tpm -= init_task_datum.data["in_tokens"]
+        self.tpm -= init_task_datum.quota_tokens
+        return
+
+    def settle_quota(self, done_task_datum):
+        # reconcile the reservation with actual usage and release the difference immediately
+        used_tokens = done_task_datum.get_used_tokens()
+        if used_tokens is not None:
+            self.tpm += done_task_datum.quota_tokens - used_tokens
+            done_task_datum.quota_tokens = used_tokens
+
+        # the run enters the done heap next, with the settled tokens
+        self.window_requests += 1
+        self.window_tokens += done_task_datum.quota_tokens
+        return
+
+
+class OpenAIAdaptiveQuotaManager(OpenAIQuotaManager):
+    # rpm and tpm are initial guesses, corrected by the x-ratelimit-* headers of every response
+    def __init__(self, rpm, tpm):
+        super().__init__(rpm, tpm)
+
+        # the latest remaining budget reported by the provider, minus what has been sent since
+        self.header_time = 0
+        self.header_requests = None
+        self.header_tokens = None
+        self.header_requests_reset_time = 0
+        self.header_tokens_reset_time = 0
+
+        self.sent_requests = 0
+        self.sent_tokens = 0
+        return
+
+    def is_blocked_by_header(self, reserved_tokens, now):
+        if self.header_requests is not None and self.header_requests <= 0:
+            if now < self.header_requests_reset_time:
+                return True
+        if self.header_tokens is not None and self.header_tokens < reserved_tokens:
+            if now < self.header_tokens_reset_time:
+                return True
+        return False
+
+    def has_enough_quota(self, init_task_datum):
+        if not super().has_enough_quota(init_task_datum):
+            return False
+        return not self.is_blocked_by_header(self.get_reserved_tokens(init_task_datum), time.time())
+
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        quota_time = super().get_quota_available_time(init_task_datum, done_task_datum_queue)
+        if quota_time is None:
+            return None
+        if self.is_blocked_by_header(self.get_reserved_tokens(init_task_datum), quota_time):
+            quota_time = max(quota_time, self.header_requests_reset_time, self.header_tokens_reset_time)
+        return quota_time
+
+    def deduct_quota(self, init_task_datum):
+        super().deduct_quota(init_task_datum)
+
+        self.sent_requests += 1
+        self.sent_tokens += init_task_datum.quota_tokens
+        init_task_datum.quota_sent = (self.sent_requests, self.sent_tokens)
+
+        if self.header_requests is not None:
+            self.header_requests -= 1
+        if self.header_tokens is not None:
+            self.header_tokens -= init_task_datum.quota_tokens
+        return
+
+    def settle_quota(self, done_task_datum):
+        super().settle_quota(done_task_datum)
+
+        headers = done_task_datum.response_headers
+        if not headers or done_task_datum.end_time < self.header_time:
+            return
+        self.header_time = done_task_datum.end_time
+
+        # headers that do not parse, e.g. empty or of another provider's format, are ignored
+        limit_requests = parse_header_count(headers.get("x-ratelimit-limit-requests"))
+        limit_tokens = parse_header_count(headers.get("x-ratelimit-limit-tokens"))
+        self.set_limit(
+            limit_requests if limit_requests is not None and limit_requests > 0 else None,
+            limit_tokens if limit_tokens is not None and limit_tokens > 0 else None,
+        )
+
+        # requests sent after this one are most likely not counted by the provider yet
+        sent_requests, sent_tokens = done_task_datum.quota_sent
+        remaining_requests = parse_header_count(headers.get("x-ratelimit-remaining-requests"))
+        if remaining_requests is not None:
+            self.header_requests = remaining_requests - (self.sent_requests - sent_requests)
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests", "0s"))
+            self.header_requests_reset_time = done_task_datum.end_time + reset
+        remaining_tokens = parse_header_count(headers.get("x-ratelimit-remaining-tokens"))
+        if remaining_tokens is not None:
+            self.header_tokens = remaining_tokens - (self.sent_tokens - sent_tokens)
+            reset = parse_duration(headers.get("x-ratelimit-reset-tokens", "0s"))
+            self.header_tokens_reset_time = done_task_datum.end_time + reset
         return
 
 
 async def openai_task_runner(task_datum):
     task_datum.start_time = time.time()
-    completion = await task_datum.client.chat.completions.create(
-        model=task_datum.data["model"],
-        n=task_datum.data["choices"],
-        messages=[
-            {"role": "user", "content": task_datum.data["text_in"]},
-        ],
+    response = await task_datum.client.chat.completions.with_raw_response.create(
+        **task_datum.get_request_kwargs(),
     )
     task_datum.end_time = time.time()
 
+    task_datum.response_headers = get_rate_limit_headers(response.headers)
+    completion = response.parse()
+
     task_datum.data["text_out_list"] = [
         choice.message.content
         for choice in completion.choices
     ]
-    task_datum.set_out_tokens()
+    await asyncio.to_thread(task_datum.set_out_tokens)
+    if completion.usage is not None:
+        task_datum.data["usage_tokens"] = completion.usage.total_tokens
 
     return task_datum
 
@@ -287,42 +2659,540 @@ async def dummy_openai_task_runner(task_datum):
         f"output-{i + 1}"
         for i in range(task_datum.data["choices"])
     ]
-    task_datum.set_out_tokens()
+    await asyncio.to_thread(task_datum.set_out_tokens)
 
     return task_datum
 
 
+"""
+Embedding
+"""
+
+# on-disk dtype name -> array/struct type code
+VECTOR_DTYPE_TO_CODE = {
+    "float64": "d",
+    "float32": "f",
+    "float16": "e",
+}
+VECTOR_CODE_TO_DTYPE = {code: dtype for dtype, code in VECTOR_DTYPE_TO_CODE.items()}
+
+
+def pack_vectors(vector_list, dtype="float64"):
+    # serialize a batch of vectors into one contiguous buffer in native byte order
+    code = VECTOR_DTYPE_TO_CODE[dtype]
+    if np is not None:
+        return np.asarray(vector_list, dtype=dtype).tobytes()
+    values = list(itertools.chain.from_iterable(vector_list))
+    if code == "e":
+        # array does not support half floats
+        return struct.pack(f"{len(values)}e", *values)
+    return array(code, values).tobytes()
+
+
+# task_id, row, dim, offset, dtype code
+EMB_INDEX_RECORD = struct.Struct("<qiiqc7x")
+
+
+class EmbeddingStore:
+    # vectors in one file, plus an index file of one record per vector
+    def __init__(self, vector_file, dtype="float64"):
+        self.vector_file = vector_file
+        self.index_file = vector_file + ".idx"
+        self.dtype = dtype
+        self.code = VECTOR_DTYPE_TO_CODE[dtype].encode("ascii")
+        self.item_size = struct.calcsize(VECTOR_DTYPE_TO_CODE[dtype])
+
+        self.vector_fw = None
+        self.index_fw = None
+        self.offset = 0
+        return
+
+    def open(self, completed_task_id_set):
+        # keep only vectors of completed tasks, so the store is consistent with the output file on resume
+        self.recover()
+        record_list = []
+        if os.path.exists(self.index_file) and os.path.exists(self.vector_file):
+            vector_bytes = os.path.getsize(self.vector_file)
+            with open(self.index_file, "rb") as f:
+                index_bytes = f.read()
+            index_bytes = index_bytes[:len(index_bytes) - len(index_bytes) % EMB_INDEX_RECORD.size]
+            for record in EMB_INDEX_RECORD.iter_unpack(index_bytes):
+                task_id, _row, dim, offset, code = record
+                end = offset + dim * struct.calcsize(code.decode("ascii"))
+                if task_id in completed_task_id_set and end <= vector_bytes:
+                    record_list.append((record, end))
+
+        self.offset = max((end for _record, end in record_list), default=0)
+        kept_bytes = sum(end - record[3] for record, end in record_list)
+        if kept_bytes < self.offset:
+            # vectors of incomplete tasks before the end of the file, so that matrix rows match index records
+            record_list = self.compact(record_list)
+            self.offset = kept_bytes
+        else:
+            tmp_index_file = self.index_file + ".tmp"
+            with open(tmp_index_file, "wb") as f:
+                f.write(b"".join(EMB_INDEX_RECORD.pack(*record) for record, _end in record_list))
+            os.replace(tmp_index_file, self.index_file)
+
+        # drop vectors of incomplete tasks at the end of the file
+        with open(self.vector_file, "ab") as f:
+            f.truncate(self.offset)
+
+        self.vector_fw = open(self.vector_file, "ab")
+        self.index_fw = open(self.index_file, "ab")
+        logger.info(f"[embedding store] resumed {len(record_list):,} vectors from {self.vector_file}")
+        return
+
+    def recover(self):
+        # finish a compaction that was interrupted after the old index was removed
+        tmp_index_file = self.index_file + ".tmp"
+        tmp_vector_file = self.vector_file + ".tmp"
+        if not os.path.exists(self.index_file) and os.path.exists(tmp_index_file):
+            if os.path.exists(tmp_vector_file):
+                os.replace(tmp_vector_file, self.vector_file)
+            os.replace(tmp_index_file, self.index_file)
+        return
+
+    def compact(self, record_list):
+        # copy kept vectors to new files in offset order, then swap them in so that recover() can roll forward
+        tmp_index_file = self.index_file + ".tmp"
+        tmp_vector_file = self.vector_file + ".tmp"
+        compact_record_list = []
+        offset = 0
+        with open(self.vector_file, "rb") as fr, open(tmp_vector_file, "wb") as fw:
+            for (task_id, row, dim, old_offset, code), end in sorted(record_list, key=lambda item: item[0][3]):
+                fr.seek(old_offset)
+                fw.write(fr.read(end - old_offset))
+                compact_record_list.append(((task_id, row, dim, offset, code), offset + end - old_offset))
+                offset += end - old_offset
+            fw.flush()
+            os.fsync(fw.fileno())
+        with open(tmp_index_file, "wb") as f:
+            f.write(b"".join(EMB_INDEX_RECORD.pack(*record) for record, _end in compact_record_list))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.remove(self.index_file)
+        os.replace(tmp_vector_file, self.vector_file)
+        os.replace(tmp_index_file, self.index_file)
+        logger.info(f"[embedding store] compacted {self.vector_file} to {offset:,} bytes")
+        return compact_record_list
+
+    def write(self, task_id, vector_list):
+        # vectors are written before their index records, so a record never points to missing bytes
+        self.vector_fw.write(pack_vectors(vector_list, self.dtype))
+
+        record_list = []
+        for row, vector in enumerate(vector_list):
+            dim = len(vector)
+            record_list.append(EMB_INDEX_RECORD.pack(task_id, row, dim, self.offset, self.code))
+            self.offset += dim * self.item_size
+        self.index_fw.write(b"".join(record_list))
+        return
+
+    def flush(self, fsync=False):
+        # vectors before index records, called before the output rows of their tasks are committed
+        if self.vector_fw is None:
+            # closed at the end of the job, before the last output commit
+            return
+        for fw in (self.vector_fw, self.index_fw):
+            fw.flush()
+            if fsync:
+                os.fsync(fw.fileno())
+        return
+
+    def close(self):
+        self.flush(fsync=True)
+        self.vector_fw.close()
+        self.index_fw.close()
+        self.vector_fw = None
+        self.index_fw = None
+        return
+
+
+class EmbeddingStoreReader:
+    def __init__(self, vector_file):
+        if np is None:
+            raise ImportError("EmbeddingStoreReader requires numpy")
+
+        index_dtype = np.dtype([
+            ("task_id", "<i8"), ("row", "<i4"), ("dim", "<i4"), ("offset", "<i8"), ("dtype", "S1"), ("pad", "V7"),
+        ])
+        assert index_dtype.itemsize == EMB_INDEX_RECORD.size
+
+        self.vector_file = vector_file
+        self.index_file = vector_file + ".idx"
+        self.index = np.memmap(self.index_file, dtype=index_dtype, mode="r") \
+            if os.path.getsize(self.index_file) else np.zeros(0, dtype=index_dtype)
+
+        # records sorted by (task_id, row) for lookup
+        self.order = np.lexsort((self.index["row"], self.index["task_id"]))
+        self.sorted_task_id = self.index["task_id"][self.order]
+
+        self.raw = np.memmap(self.vector_file, dtype=np.uint8, mode="r") \
+            if os.path.getsize(self.vector_file) else np.zeros(0, dtype=np.uint8)
+        self.matrix = None
+        if len(self.index):
+            dim_set = set(np.unique(self.index["dim"]).tolist())
+            code_set = set(np.unique(self.index["dtype"]).tolist())
+            if len(dim_set) == 1 and len(code_set) == 1:
+                self.dim = dim_set.pop()
+                self.dtype = VECTOR_CODE_TO_DTYPE[code_set.pop().decode("ascii")]
+                row_bytes = self.dim * np.dtype(self.dtype).itemsize
+                rows = len(self.raw) // row_bytes
+                self.matrix = self.raw[:rows * row_bytes].view(self.dtype).reshape(rows, self.dim)
+        return
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_record_list(self, task_id):
+        i = np.searchsorted(self.sorted_task_id, task_id, side="left")
+        j = np.searchsorted(self.sorted_task_id, task_id, side="right")
+        return self.index[self.order[i:j]]
+
+    def get(self, task_id):
+        # vectors of a task in row order, a zero-copy view when they are contiguous
+        record_list = self.get_record_list(task_id)
+        if self.matrix is None:
+            return [
+                np.frombuffer(
+                    self.raw, dtype=VECTOR_CODE_TO_DTYPE[record["dtype"].decode("ascii")],
+                    count=int(record["dim"]), offset=int(record["offset"]),
+                )
+                for record in record_list
+            ]
+        row_index = record_list["offset"] // (self.dim * self.matrix.itemsize)
+        if len(row_index) and row_index[-1] - row_index[0] + 1 == len(row_index):
+            return self.matrix[row_index[0]:row_index[-1] + 1]
+        return self.matrix[row_index]
+
+
+class EmbeddingPacker:
+    # pack the texts of many input rows into requests of up to max_inputs texts and max_tokens tokens,
+    # split rows that do not fit in one request, and scatter the returned vectors back to the rows
+    # with dedup, each distinct (model, dimension, text) is sent once and its vector fans out to every occurrence,
+    # vectors are kept for later occurrences in an LRU of up to max_memo_bytes
+    def __init__(self, max_inputs=2048, max_tokens=300000, dedup=False, max_memo_bytes=64 << 20):
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.dedup = dedup
+        self.max_memo_bytes = max_memo_bytes
+
+        # (row task datum, text index list, text key list, tokens) of texts read but not yet packed into a request
+        self.piece_queue = deque()
+        # text key -> (row task datum, text index) of every occurrence waiting for the vector of a queued or sent text
+        self.key_to_target_list = {}
+        self.next_key = 0
+        # row task datum -> texts without vector yet, rows of failed requests are removed
+        self.row_to_pending_texts = {}
+        # rows whose texts all have vectors, to be finished and written
+        self.done_row_queue = deque()
+        # text key -> vector of returned texts, with dedup
+        self.key_to_vector = OrderedDict()
+        self.memo_bytes = 0
+
+        self.rows = 0
+        self.requests = 0
+        self.texts = 0
+        self.sent_texts = 0
+        self.tokens = 0
+        self.sent_tokens = 0
+        return
+
+    def get_request_key(self, data):
+        # only texts of the same model and dimension can share a request
+        return data.get("model"), data.get("dimension")
+
+    def get_text_key(self, model, dimension, text):
+        return hashlib.blake2b(f"{model}\0{dimension}\0{text}".encode("utf8"), digest_size=16).digest()
+
+    def get_vector_bytes(self, vector):
+        # a list of floats: the list, its pointers, and the float objects
+        return 56 + 32 * len(vector)
+
+    def add_row(self, row_task_datum):
+        text_list = row_task_datum.data["text_list"]
+        in_tokens = row_task_datum.data.get("in_tokens", 0)
+        row_task_datum.vector_list = [None] * len(text_list)
+        self.rows += 1
+        self.texts += len(text_list)
+        self.tokens += in_tokens
+
+        # per-text tokens are only needed to split a row, or to size requests of deduplicated texts,
+        # they are usually counted off the event loop with in_tokens, else count them here
+        tokenizer = getattr(row_task_datum, "tokenizer", None)
+        fits = len(text_list) <= self.max_inputs and in_tokens <= self.max_tokens
+        tokens_list = getattr(row_task_datum, "text_tokens_list", None)
+        if tokenizer is None or (fits and not self.dedup):
+            tokens_list = None
+        elif tokens_list is None:
+            tokens_list = count_tokens(tokenizer, text_list, getattr(row_task_datum, "token_cache", None))
+
+        # texts to send, the others already have a vector or wait for the same text sent for an earlier occurrence
+        send_index_list = []
+        send_key_list = []
+        pending_texts = 0
+        if self.dedup:
+            model, dimension = self.get_request_key(row_task_datum.data)
+            for i, text in enumerate(text_list):
+                key = self.get_text_key(model, dimension, text)
+                vector = self.key_to_vector.get(key)
+                if vector is not None:
+                    self.key_to_vector.move_to_end(key)
+                    row_task_datum.vector_list[i] = vector
+                    continue
+                pending_texts += 1
+                target_list = self.key_to_target_list.get(key)
+                if target_list is None:
+                    self.key_to_target_list[key] = [(row_task_datum, i)]
+                    send_index_list.append(i)
+                    send_key_list.append(key)
+                else:
+                    target_list.append((row_task_datum, i))
+        else:
+            for i in range(len(text_list)):
+                key = self.next_key
+                self.next_key += 1
+                self.key_to_target_list[key] = [(row_task_datum, i)]
+                send_index_list.append(i)
+                send_key_list.append(key)
+            pending_texts = len(text_list)
+
+        if pending_texts == 0:
+            row_task_datum.start_time = row_task_datum.end_time = time.time()
+            self.done_row_queue.append(row_task_datum)
+            return
+        self.row_to_pending_texts[row_task_datum] = pending_texts
+
+        # split at text boundaries, a single text above max_tokens still goes alone and fails at the provider
+        piece_list = []
+        piece_index_list = []
+        piece_key_list = []
+        piece_tokens = 0
+        for i, key in zip(send_index_list, send_key_list):
+            text_tokens = 0 if tokens_list is None else tokens_list[i]
+            if piece_index_list and (
+                    len(piece_index_list) >= self.max_inputs or piece_tokens + text_tokens > self.max_tokens
+            ):
+                piece_list.append((row_task_datum, piece_index_list, piece_key_list, piece_tokens))
+                piece_index_list = []
+                piece_key_list = []
+                piece_tokens = 0
+            piece_index_list.append(i)
+            piece_key_list.append(key)
+            piece_tokens += text_tokens
+        if piece_index_list:
+            piece_list.append((row_task_datum, piece_index_list, piece_key_list, piece_tokens))
+        if tokens_list is None and len(piece_list) == 1:
+            row_task_datum, piece_index_list, piece_key_list, _piece_tokens = piece_list[0]
+            piece_list[0] = (row_task_datum, piece_index_list, piece_key_list, in_tokens)
+        self.piece_queue.extend(piece_list)
+        return
+
+    def get(self, input_reader, task_datum_class):
+        # the next request, packed from leftover pieces and rows ready in the input reader, or None
+        piece_list = []
+        key = None
+        texts = 0
+        tokens = 0
+        while True:
+            if not self.piece_queue:
+                input_item = input_reader.get()
+                if input_item is None:
+                    break
+                input_task_id, line_data = input_item
+                self.add_row(task_datum_class(input_task_id, line_data))
+                continue
+
+            row_task_datum, index_list, _key_list, piece_tokens = self.piece_queue[0]
+            piece_key = self.get_request_key(row_task_datum.data)
+            if piece_list and (
+                    piece_key != key
+                    or texts + len(index_list) > self.max_inputs
+                    or tokens + piece_tokens > self.max_tokens
+            ):
+                break
+            piece_list.append(self.piece_queue.popleft())
+            key = piece_key
+            texts += len(index_list)
+            tokens += piece_tokens
+
+        if not piece_list:
+            return None
+
+        request_data = {
+            "text_list": [
+                row_task_datum.data["text_list"][i]
+                for row_task_datum, index_list, _key_list, _piece_tokens in piece_list
+                for i in index_list
+            ],
+            "in_tokens": tokens,
+        }
+        model, dimension = key
+        if model is not None:
+            request_data["model"] = model
+        if dimension is not None:
+            request_data["dimension"] = dimension
+
+        request_task_id = f"{piece_list[0][0].task_id}-{piece_list[-1][0].task_id}"
+        request_task_datum = task_datum_class(request_task_id, request_data)
+        request_task_datum.key_list = [
+            text_key
+            for _row_task_datum, _index_list, key_list, _piece_tokens in piece_list
+            for text_key in key_list
+        ]
+        self.requests += 1
+        self.sent_texts += texts
+        self.sent_tokens += tokens
+        return request_task_datum
+
+    def scatter(self, request_task_datum):
+        # copy the vectors of a successful request to every waiting occurrence, queue rows whose texts all returned
+        for key, vector in zip(request_task_datum.key_list, request_task_datum.vector_list):
+            for row_task_datum, i in self.key_to_target_list.pop(key, ()):
+                if row_task_datum not in self.row_to_pending_texts:
+                    continue
+                row_task_datum.vector_list[i] = vector
+                row_task_datum.run_id = max(row_task_datum.run_id, request_task_datum.run_id)
+                if not row_task_datum.start_time or request_task_datum.start_time < row_task_datum.start_time:
+                    row_task_datum.start_time = request_task_datum.start_time
+                row_task_datum.end_time = max(row_task_datum.end_time, request_task_datum.end_time)
+
+                self.row_to_pending_texts[row_task_datum] -= 1
+                if self.row_to_pending_texts[row_task_datum] == 0:
+                    del self.row_to_pending_texts[row_task_datum]
+                    self.done_row_queue.append(row_task_datum)
+
+            if self.dedup:
+                vector_bytes = self.get_vector_bytes(vector)
+                if vector_bytes <= self.max_memo_bytes:
+                    self.key_to_vector[key] = vector
+                    self.memo_bytes += vector_bytes
+                while self.memo_bytes > self.max_memo_bytes:
+                    _key, old_vector = self.key_to_vector.popitem(last=False)
+                    self.memo_bytes -= self.get_vector_bytes(old_vector)
+
+        # the request stays in the quota window for a while, do not keep vectors alive with it
+        request_task_datum.key_list = []
+        request_task_datum.vector_list = []
+        return
+
+    def drop(self, request_task_datum):
+        # rows waiting for a request that will not run again, their other texts are discarded when they return
+        dropped_row_list = []
+        for key in request_task_datum.key_list:
+            for row_task_datum, _i in self.key_to_target_list.pop(key, ()):
+                if self.row_to_pending_texts.pop(row_task_datum, None) is not None:
+                    dropped_row_list.append(row_task_datum)
+        request_task_datum.key_list = []
+        return dropped_row_list
+
+    def get_done_row_list(self):
+        done_row_list = list(self.done_row_queue)
+        self.done_row_queue.clear()
+        return done_row_list
+
+    def get_stats(self):
+        return {
+            "rows": self.rows,
+            "requests": self.requests,
+            "texts": self.texts,
+            "sent_texts": self.sent_texts,
+            "tokens": self.tokens,
+            "sent_tokens": self.sent_tokens,
+            "saved_tokens": self.tokens - self.sent_tokens,
+        }
+
+    def get_log_string(self):
+        log_string = f"[embedding packer] packed {self.rows:,} rows into {self.requests:,} requests"
+        if self.dedup:
+            log_string += (
+                f", sent {self.sent_texts:,} unique of {self.texts:,} texts,"
+                f" {self.sent_tokens:,} of {self.tokens:,} tokens ({self.tokens - self.sent_tokens:,} saved)"
+            )
+        return log_string
+
+
 """
 OpenAI Embedding
 """
 
 
 class OpenAIEmbTaskDatum(BasicTaskDatum):
+    read_fields = ("text_list", "model", "dimension", "in_tokens")
     tokenizer = None
+    token_cache = None
     client = None
     bytes_file = None
+    bytes_dtype = "float64"
+    emb_store = None
 
     def __init__(self, task_id, data):
         super().__init__(task_id, data)
 
-        self.data["in_tokens"] = sum(
-            len(self.tokenizer.encode(text))
-            for text in self.data["text_list"]
-        )
+        # tokens of every text, counted off the event loop in prepare_data_list, e.g. for EmbeddingPacker to split rows
+        self.text_tokens_list = self.data.pop("_text_tokens_list", None)
+        if "in_tokens" not in self.data:
+            self.text_tokens_list = count_tokens(self.tokenizer, self.data["text_list"], self.token_cache) \
+                if self.data["text_list"] else []
+            self.data["in_tokens"] = sum(self.text_tokens_list)
         self.vector_list = []
         return
 
+    @classmethod
+    def prepare_data_list(cls, data_list):
+        text_list = [text for data in data_list for text in data["text_list"]]
+        tokens_list = count_tokens(cls.tokenizer, text_list, cls.token_cache) if text_list else []
+        i = 0
+        for data in data_list:
+            j = i + len(data["text_list"])
+            # private, popped by __init__ so that it is not written to the output
+            data["_text_tokens_list"] = tokens_list[i:j]
+            data["in_tokens"] = sum(tokens_list[i:j])
+            i = j
+        return
+
+    @classmethod
+    async def start_job(cls, completed_task_id_set):
+        if cls.emb_store is not None:
+            cls.emb_store.open(completed_task_id_set)
+        return
+
+    @classmethod
+    async def end_job(cls):
+        if cls.emb_store is not None:
+            cls.emb_store.close()
+        if cls.token_cache is not None:
+            logger.info(cls.token_cache.get_log_string())
+        return
+
+    @classmethod
+    def flush_job(cls, fsync):
+        if cls.emb_store is not None:
+            cls.emb_store.flush(fsync)
+        elif cls.bytes_file is not None:
+            cls.bytes_file.flush()
+        return
+
     def finish(self):
-        for vector in self.vector_list:
-            for v in vector:
-                v = struct.pack("d", v)
-                self.bytes_file.write(v)
+        # without a sink, e.g. with iterate_batch_data, vectors stay in vector_list
+        if self.emb_store is not None:
+            self.emb_store.write(self.task_id, self.vector_list)
+        elif self.bytes_file is not None:
+            self.bytes_file.write(pack_vectors(self.vector_list, self.bytes_dtype))
+        return
+
+    def release(self):
+        super().release()
+        self.vector_list = []
+        self.text_tokens_list = None
         return
 
 
 async def openai_emb_task_runner(task_datum):
     task_datum.start_time = time.time()
-    completion = await task_datum.client.embeddings.create(
+    response = await task_datum.client.embeddings.with_raw_response.create(
         input=task_datum.data["text_list"],
         model=task_datum.data.get("model", "text-embedding-3-small"),
         dimensions=task_datum.data.get("dimension", 256),
@@ -330,6 +3200,12 @@ async def openai_emb_task_runner(task_datum):
     )
     task_datum.end_time = time.time()
 
+    task_datum.response_headers = get_rate_limit_headers(response.headers)
+    completion = response.parse()
+
+    if completion.usage is not None:
+        task_datum.data["usage_tokens"] = completion.usage.total_tokens
+
     task_datum.vector_list = [
         datum.embedding
         for datum in completion.data
@@ -343,6 +3219,7 @@ Deep Infra
 
 
 class DeepInfraTaskDatum(BasicTaskDatum):
+    read_fields = ("text_in", "model", "choices")
     client = None
 
     def __init__(self, task_id, data):
@@ -351,42 +3228,80 @@ class DeepInfraTaskDatum(BasicTaskDatum):
         self.data["text_out_list"] = []
         return
 
+    def get_request_kwargs(self):
+        return {
+            "model": self.data["model"],
+            "n": self.data["choices"],
+            "messages": [
+                {"role": "user", "content": self.data["text_in"]},
+            ],
+        }
+
+    def get_cache_key(self):
+        return {"provider": "deepinfra", **self.get_request_kwargs()}
+
+    def get_cache_value(self):
+        return {"text_out_list": self.data["text_out_list"]}
+
+    def set_cache_value(self, value):
+        self.data["text_out_list"] = value["text_out_list"]
+        return
+
 
 class DeepInfraQuotaManager(BasicQuotaManager):
+    # a run holds its slot until it is done, so done runs need no 60-second window
+    uses_done_queue = False
+
     def __init__(self, max_concurrent_requests):
         super().__init__()
         self.requests_quota = max_concurrent_requests
+        self.max_concurrent_requests = max_concurrent_requests
+        return
+
+    def set_quota_share(self, quota_share):
+        self.requests_quota += get_quota_share(self.max_concurrent_requests, quota_share) \
+            - get_quota_share(self.max_concurrent_requests, self.quota_share)
+        self.quota_share = quota_share
         return
 
+    def get_headroom(self):
+        return self.requests_quota / get_quota_share(self.max_concurrent_requests, self.quota_share)
+
+    def get_usage(self):
+        limit = get_quota_share(self.max_concurrent_requests, self.quota_share)
+        return {"concurrent_requests": (limit - self.requests_quota, limit)}
+
     def has_enough_quota(self, init_task_datum):
         return self.requests_quota > 0
 
     def reclaim_quota(self, done_task_datum_queue):
-        while done_task_datum_queue:
-            heapq.heappop(done_task_datum_queue)
-            self.requests_quota += 1
         return
 
     def deduct_quota(self, init_task_datum):
         self.requests_quota -= 1
         return
 
+    def settle_quota(self, done_task_datum):
+        self.requests_quota += 1
+        return
+
 
 async def deepinfra_task_runner(task_datum):
     task_datum.start_time = time.time()
-    completion = await task_datum.client.chat.completions.create(
-        model=task_datum.data["model"],
-        n=task_datum.data["choices"],
-        messages=[
-            {"role": "user", "content": task_datum.data["text_in"]},
-        ],
+    response = await task_datum.client.chat.completions.with_raw_response.create(
+        **task_datum.get_request_kwargs(),
     )
     task_datum.end_time = time.time()
 
+    task_datum.response_headers = get_rate_limit_headers(response.headers)
+    completion = response.parse()
+
     task_datum.data["text_out_list"] = [
         choice.message.content
         for choice in completion.choices
     ]
+    if completion.usage is not None:
+        task_datum.data["usage_tokens"] = completion.usage.total_tokens
 
     return task_datum
 
@@ -397,8 +3312,11 @@ Deep Infra Embedding
 
 
 class DeepInfraEmbTaskDatum(BasicTaskDatum):
+    read_fields = ("text_list", "model", "dimension")
     client = None
     bytes_file = None
+    bytes_dtype = "float64"
+    emb_store = None
 
     def __init__(self, task_id, data):
         super().__init__(task_id, data)
@@ -406,23 +3324,54 @@ class DeepInfraEmbTaskDatum(BasicTaskDatum):
         self.vector_list = []
         return
 
+    @classmethod
+    async def start_job(cls, completed_task_id_set):
+        if cls.emb_store is not None:
+            cls.emb_store.open(completed_task_id_set)
+        return
+
+    @classmethod
+    async def end_job(cls):
+        if cls.emb_store is not None:
+            cls.emb_store.close()
+        return
+
+    @classmethod
+    def flush_job(cls, fsync):
+        if cls.emb_store is not None:
+            cls.emb_store.flush(fsync)
+        elif cls.bytes_file is not None:
+            cls.bytes_file.flush()
+        return
+
     def finish(self):
-        for vector in self.vector_list:
-            for v in vector:
-                v = struct.pack("d", v)
-                self.bytes_file.write(v)
+        # without a sink, e.g. with iterate_batch_data, vectors stay in vector_list
+        if self.emb_store is not None:
+            self.emb_store.write(self.task_id, self.vector_list)
+        elif self.bytes_file is not None:
+            self.bytes_file.write(pack_vectors(self.vector_list, self.bytes_dtype))
+        return
+
+    def release(self):
+        super().release()
+        self.vector_list = []
         return
 
 
 async def deepinfra_emb_task_runner(task_datum):
     task_datum.start_time = time.time()
-    completion = await task_datum.client.embeddings.create(
+    response = await task_datum.client.embeddings.with_raw_response.create(
         input=task_datum.data["text_list"],
         model=task_datum.data["model"],
         encoding_format="float",
     )
     task_datum.end_time = time.time()
 
+    task_datum.response_headers = get_rate_limit_headers(response.headers)
+    completion = response.parse()
+    if completion.usage is not None:
+        task_datum.data["usage_tokens"] = completion.usage.total_tokens
+
     task_datum.vector_list = [
         datum.embedding
         for datum in completion.data
@@ -436,8 +3385,10 @@ FedGPT
 
 
 class FedGPTTaskDatum(BasicTaskDatum):
+    read_fields = ("text_in", "model")
     api_key = ""
     api_url = ""
+    http_client = HTTPClient(ssl=False)
 
     def __init__(self, task_id, data):
         super().__init__(task_id, data)
@@ -445,40 +3396,83 @@ class FedGPTTaskDatum(BasicTaskDatum):
         self.data["text_out"] = ""
         return
 
+    @classmethod
+    async def start_job(cls, completed_task_id_set):
+        await cls.http_client.open()
+        return
+
+    @classmethod
+    async def end_job(cls):
+        await cls.http_client.close()
+        return
+
+    def get_request_json(self):
+        return {
+            "model": self.data["model"],
+            "mode": "normal",
+            "messages": [
+                {"role": "user", "content": self.data["text_in"]},
+            ],
+        }
+
+    def get_cache_key(self):
+        return {"provider": "fedgpt", "api_url": self.api_url, **self.get_request_json()}
+
+    def get_cache_value(self):
+        return {"text_out": self.data["text_out"]}
+
+    def set_cache_value(self, value):
+        self.data["text_out"] = value["text_out"]
+        return
+
 
 class FedGPTQuotaManager(BasicQuotaManager):
+    # a run holds its slot until it is done, so done runs need no 60-second window
+    uses_done_queue = False
+
     def __init__(self, max_concurrent_requests):
         super().__init__()
         self.requests_quota = max_concurrent_requests
+        self.max_concurrent_requests = max_concurrent_requests
+        return
+
+    def set_quota_share(self, quota_share):
+        self.requests_quota += get_quota_share(self.max_concurrent_requests, quota_share) \
+            - get_quota_share(self.max_concurrent_requests, self.quota_share)
+        self.quota_share = quota_share
         return
 
+    def get_headroom(self):
+        return self.requests_quota / get_quota_share(self.max_concurrent_requests, self.quota_share)
+
+    def get_usage(self):
+        limit = get_quota_share(self.max_concurrent_requests, self.quota_share)
+        return {"concurrent_requests": (limit - self.requests_quota, limit)}
+
     def has_enough_quota(self, init_task_datum):
         return self.requests_quota > 0
 
     def reclaim_quota(self, done_task_datum_queue):
-        while done_task_datum_queue:
-            heapq.heappop(done_task_datum_queue)
-            self.requests_quota += 1
         return
 
     def deduct_quota(self, init_task_datum):
         self.requests_quota -= 1
         return
 
+    def settle_quota(self, done_task_datum):
+        self.requests_quota += 1
+        return
+
 
 async def fedgpt_task_runner(task_datum):
     task_datum.start_time = time.time()
-    obj = {
-        "model": task_datum.data["model"],
-        "mode": "normal",
-        "messages": [
-            {"role": "user", "content": task_datum.data["text_in"]},
-        ],
-    }
+    obj = task_datum.get_request_json()
     headers = {"Accept": "application/json", "x-api-key": task_datum.api_key}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(task_datum.api_url, headers=headers, json=obj, ssl=False) as responses:
-            responses = await responses.json()
+    # an error status raises aiohttp.ClientResponseError with the status and headers, e.g. Retry-After, for RetryPolicy
+    async with task_datum.http_client.session.post(
+            task_datum.api_url, headers=headers, json=obj, raise_for_status=True,
+    ) as responses:
+        responses = await responses.json()
     task_datum.end_time = time.time()
 
     task_datum.data["text_out"] = responses["messages"][0]["content"]
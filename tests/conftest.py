@@ -0,0 +1,13 @@
+import pytest
+
+from async_utils import BasicQuotaManager
+
+
+@pytest.fixture
+def get_quota_manager():
+    # a fresh quota manager per job, with a run limit that never throttles a test job
+    def get_quota_manager():
+        quota_manager = BasicQuotaManager()
+        quota_manager.runs_per_minute = quota_manager.runs_per_minute_limit = 1000000
+        return quota_manager
+    return get_quota_manager
@@ -0,0 +1,106 @@
+import time
+import heapq
+import asyncio
+import collections
+
+from async_utils import (
+    iterate_batch_data, BasicTaskDatum, OpenAIQuotaManager, ClientPoolQuotaManager, RetryPolicy,
+)
+from async_utils.async_utils import QuotaRecord
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class TaskDatum(BasicTaskDatum):
+    member_name = None
+
+    def get_estimated_tokens(self):
+        return 10
+
+    def get_used_tokens(self):
+        return None
+
+
+def get_pool(rpm_list, **kwargs):
+    return ClientPoolQuotaManager(
+        [({"member_name": f"m{member}"}, OpenAIQuotaManager(rpm, 10 ** 6)) for member, rpm in enumerate(rpm_list)],
+        **kwargs,
+    )
+
+
+def run(pool, task_runner, tasks, **kwargs):
+    async def main():
+        return [
+            task_datum
+            async for task_datum in iterate_batch_data(
+                [{}] * tasks, TaskDatum, task_runner, pool, retry_policy=RetryPolicy(base_delay=0), **kwargs,
+            )
+        ]
+    return asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_runs_are_routed_by_headroom():
+    pool = get_pool([4, 8])
+    member_counter = collections.Counter()
+
+    async def task_runner(task_datum):
+        member_counter[task_datum.member_name] += 1
+        return task_datum
+
+    task_datum_list = run(pool, task_runner, 6)
+    assert not any(task_datum.run_failed for task_datum in task_datum_list)
+    # the member with the larger quota keeps the most headroom, so it takes most runs
+    assert member_counter == {"m0": 2, "m1": 4}
+    assert pool.runs_list == [2, 4]
+
+
+def test_throttled_member_cools_down():
+    pool = get_pool([100, 100], cooldown=30)
+    member_counter = collections.Counter()
+
+    async def task_runner(task_datum):
+        member_counter[task_datum.member_name] += 1
+        await asyncio.sleep(0.01)
+        if task_datum.member_name == "m0":
+            raise StatusError(429)
+        return task_datum
+
+    task_datum_list = run(pool, task_runner, 4)
+    assert not any(task_datum.run_failed for task_datum in task_datum_list)
+    assert all(task_datum.member_name == "m1" for task_datum in task_datum_list)
+    # the concurrent 429s of runs sent before the cooldown count once
+    assert pool.failures_list == [1, 0]
+    assert pool.cooldown_end_time_list[0] > time.time() + 20
+    assert member_counter["m0"] == 2
+
+
+def test_done_runs_return_to_member_windows():
+    pool = get_pool([2, 2])
+    init_task_datum = TaskDatum(1, {})
+    done_task_datum_queue = []
+    now = time.time()
+    for done_task_datum_queue_id, end_time in enumerate([now - 61, now - 30, now - 10]):
+        task_datum = TaskDatum(done_task_datum_queue_id + 1, {})
+        pool.deduct_quota(task_datum)
+        task_datum.run_failed = False
+        pool.settle_quota(task_datum)
+        heapq.heappush(done_task_datum_queue, (end_time, done_task_datum_queue_id, QuotaRecord(task_datum)))
+    assert [quota_manager.rpm for quota_manager in pool.quota_manager_list] == [0, 1]
+
+    pool.reclaim_quota(done_task_datum_queue)
+    assert not done_task_datum_queue
+    # members take runs in turn, the expired run of member 0 is reclaimed, the other runs stay in their windows
+    assert [len(queue) for queue in pool.done_task_datum_queue_list] == [1, 1]
+    assert [quota_manager.rpm for quota_manager in pool.quota_manager_list] == [1, 1]
+
+    pool.deduct_quota(init_task_datum)
+    pool.deduct_quota(TaskDatum(5, {}))
+    assert not pool.has_enough_quota(init_task_datum)
+    # member 1's run expires first
+    assert pool.get_quota_available_time(init_task_datum, done_task_datum_queue) == now - 30 + 60
+    pool.cooldown_end_time_list[1] = now + 45
+    assert pool.get_quota_available_time(init_task_datum, done_task_datum_queue) == now + 45
@@ -0,0 +1,196 @@
+import os
+import json
+import types
+import asyncio
+import threading
+import multiprocessing
+
+import pytest
+
+from async_utils import (
+    process_batch_data, OpenAIEmbTaskDatum, OpenAIQuotaManager, openai_emb_task_runner, OutputWriter,
+    EmbeddingStore, EmbeddingPacker,
+)
+
+np = pytest.importorskip("numpy")
+from async_utils import EmbeddingStoreReader  # noqa: E402
+
+DIMENSION = 4
+
+
+class SplitTokenizer:
+    def __init__(self):
+        # texts encoded on the main thread, i.e. on the event loop
+        self.main_thread_texts = 0
+        return
+
+    def count(self, text_list):
+        if threading.current_thread() is threading.main_thread():
+            self.main_thread_texts += len(text_list)
+        return
+
+    def encode(self, text):
+        self.count([text])
+        return text.split()
+
+    def encode_batch(self, text_list, num_threads=8):
+        self.count(text_list)
+        return [text.split() for text in text_list]
+
+
+class RawResponse:
+    def __init__(self, completion):
+        self.completion = completion
+        self.headers = {}
+
+    def parse(self):
+        return self.completion
+
+
+def get_vector(text):
+    return [float(len(text)) + k for k in range(DIMENSION)]
+
+
+class Embeddings:
+    @property
+    def with_raw_response(self):
+        return self
+
+    async def create(self, input, model, dimensions, encoding_format):
+        await asyncio.sleep(0)
+        return RawResponse(types.SimpleNamespace(
+            data=[types.SimpleNamespace(embedding=get_vector(text)) for text in input],
+            usage=types.SimpleNamespace(total_tokens=len(input)),
+        ))
+
+
+def get_text_list(task_id):
+    return [f"text {task_id} " + "x" * row for row in range(1 + task_id % 3)]
+
+
+@pytest.fixture
+def files(tmp_path):
+    input_file = str(tmp_path / "in.jsonl")
+    output_file = str(tmp_path / "out.jsonl")
+    vector_file = str(tmp_path / "emb.bin")
+    with open(input_file, "w", encoding="utf8") as f:
+        for task_id in range(1, 101):
+            f.write(json.dumps({"text_list": get_text_list(task_id), "dimension": DIMENSION}) + "\n")
+    return input_file, output_file, vector_file
+
+
+def run(input_file, output_file, vector_file, crash_after=None, packer=None):
+    # a throwaway subclass, so the shipped class keeps its tokenizer, client, and store
+    task_datum_class = type("TaskDatum", (OpenAIEmbTaskDatum,), {
+        "tokenizer": SplitTokenizer(),
+        "client": types.SimpleNamespace(embeddings=Embeddings()),
+        "emb_store": EmbeddingStore(vector_file, dtype="float32"),
+    })
+
+    async def task_runner(task_datum):
+        if crash_after is not None:
+            # tasks finish in task_id order, the crash leaves rows after crash_after uncommitted
+            await asyncio.sleep(0.002 * task_datum.task_id)
+            if task_datum.task_id > crash_after:
+                os._exit(1)
+        return await openai_emb_task_runner(task_datum)
+
+    asyncio.run(process_batch_data(
+        input_file, output_file, task_datum_class, task_runner, OpenAIQuotaManager(10000, 10 ** 9),
+        output_writer=OutputWriter(max_rows=7), packer=packer,
+    ))
+    return task_datum_class
+
+
+def assert_consistent(output_file, vector_file, task_id_list):
+    with open(output_file, encoding="utf8") as f:
+        output_task_id_list = [json.loads(line)["task_id"] for line in f]
+    assert sorted(output_task_id_list) == list(task_id_list)
+
+    reader = EmbeddingStoreReader(vector_file)
+    assert len(reader) == sum(len(get_text_list(task_id)) for task_id in task_id_list)
+    assert reader.matrix.shape == (len(reader), DIMENSION)
+    for task_id in task_id_list:
+        vector_list = reader.get(task_id)
+        assert np.allclose(vector_list, [get_vector(text) for text in get_text_list(task_id)])
+    return
+
+
+def test_store_matches_output(files):
+    input_file, output_file, vector_file = files
+    run(input_file, output_file, vector_file)
+    assert_consistent(output_file, vector_file, range(1, 101))
+
+
+def test_resume_after_crash(files):
+    input_file, output_file, vector_file = files
+    process = multiprocessing.get_context("fork").Process(
+        target=run, args=(input_file, output_file, vector_file), kwargs={"crash_after": 40},
+    )
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    # every committed row has its vectors
+    with open(output_file, encoding="utf8") as f:
+        task_id_list = [json.loads(line)["task_id"] for line in f]
+    assert task_id_list
+    reader = EmbeddingStoreReader(vector_file)
+    for task_id in task_id_list:
+        assert len(reader.get(task_id)) == len(get_text_list(task_id))
+
+    run(input_file, output_file, vector_file)
+    assert_consistent(output_file, vector_file, range(1, 101))
+
+
+def test_open_compacts_vectors_of_incomplete_tasks(files):
+    input_file, output_file, vector_file = files
+    run(input_file, output_file, vector_file)
+
+    # drop rows in the middle of the output, as if they were never committed
+    with open(output_file, "rb") as f:
+        line_list = f.readlines()
+    with open(output_file, "wb") as f:
+        f.writelines(line_list[:30] + line_list[60:])
+    os.remove(output_file + ".ckpt")
+
+    run(input_file, output_file, vector_file)
+    assert_consistent(output_file, vector_file, range(1, 101))
+    assert not os.path.exists(vector_file + ".tmp")
+
+
+def test_recover_interrupted_compaction(tmp_path):
+    vector_file = str(tmp_path / "emb.bin")
+    store = EmbeddingStore(vector_file, dtype="float32")
+    store.open(set())
+    for task_id in range(1, 4):
+        store.write(task_id, [get_vector(f"text {task_id}")])
+    store.close()
+
+    # a crash after the old index was removed, before the compacted files were swapped in
+    store.open({1, 3})
+    store.close()
+    os.replace(vector_file + ".idx", vector_file + ".idx.tmp")
+    with open(vector_file, "ab") as f:
+        f.write(b"\0" * 64)
+    os.replace(vector_file, vector_file + ".tmp")
+    with open(vector_file, "wb") as f:
+        f.write(b"\1" * 64)
+
+    store.open({1, 3})
+    store.close()
+    reader = EmbeddingStoreReader(vector_file)
+    assert len(reader) == 2
+    assert np.allclose(reader.get(3), [get_vector("text 3")])
+
+
+@pytest.mark.parametrize("dedup", [False, True])
+def test_packer_does_not_tokenize_on_event_loop(files, dedup):
+    input_file, output_file, vector_file = files
+    packer = EmbeddingPacker(max_inputs=4, max_tokens=8, dedup=dedup)
+    task_datum_class = run(input_file, output_file, vector_file, packer=packer)
+    assert task_datum_class.tokenizer.main_thread_texts == 0
+    assert_consistent(output_file, vector_file, range(1, 101))
+    with open(output_file, encoding="utf8") as f:
+        assert all("_text_tokens_list" not in json.loads(line)["data"] for line in f)
+
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from async_utils import iterate_batch_data, FedGPTTaskDatum, FedGPTQuotaManager, HTTPClient, RetryPolicy, fedgpt_task_runner
+
+web = pytest.importorskip("aiohttp.web")
+
+
+def run(status_list):
+    # responses of a single task's runs: status_list in order, with a json error body, then a completion
+    status_iterator = iter(status_list)
+
+    async def handler(request):
+        status = next(status_iterator, 200)
+        if status != 200:
+            return web.json_response({"error": "unavailable"}, status=status, headers={"Retry-After": "0"})
+        return web.json_response({"messages": [{"role": "assistant", "content": "ok"}]})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/chat", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        task_datum_class = type("TaskDatum", (FedGPTTaskDatum,), {
+            "api_url": f"http://127.0.0.1:{port}/chat", "http_client": HTTPClient(),
+        })
+        try:
+            return [
+                task_datum
+                async for task_datum in iterate_batch_data(
+                    [{"text_in": "a", "model": "m"}], task_datum_class, fedgpt_task_runner, FedGPTQuotaManager(10),
+                    max_task_runs=1, retry_policy=RetryPolicy(base_delay=60),
+                )
+            ]
+        finally:
+            await runner.cleanup()
+
+    task_datum_list = asyncio.run(asyncio.wait_for(main(), 10))
+    assert len(task_datum_list) == 1
+    return task_datum_list[0]
+
+
+def test_throttled_response_is_retried_after_header():
+    # a 429 is throttled, so it does not spend the single run, and Retry-After overrides the 60s backoff
+    task_datum = run([429, 429])
+    assert not task_datum.run_failed
+    assert task_datum.throttled_runs == 2
+    assert task_datum.data["text_out"] == "ok"
+
+
+def test_fatal_response_is_not_retried():
+    task_datum = run([400])
+    assert task_datum.run_failed
+    assert task_datum.run_id == 1
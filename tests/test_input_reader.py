@@ -0,0 +1,171 @@
+import json
+import asyncio
+import threading
+
+import pytest
+
+from async_utils import process_batch_data, iterate_batch_data, BasicTaskDatum, InputReader, IterableInputReader
+
+
+async def noop_task_runner(task_datum):
+    return task_datum
+
+
+def write_input(input_file, x_list):
+    with open(input_file, "w", encoding="utf8") as f:
+        for x in x_list:
+            f.write(json.dumps({"x": x}) + "\n")
+    return
+
+
+def read_output(output_file):
+    with open(output_file, encoding="utf8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("use_thread", [False, True])
+def test_reader_reused_for_next_file(tmp_path, get_quota_manager, use_thread):
+    input_reader = InputReader(use_thread=use_thread)
+    for name in ["a", "b"]:
+        input_file = str(tmp_path / f"{name}.jsonl")
+        output_file = str(tmp_path / f"{name}.out.jsonl")
+        write_input(input_file, range(5))
+        asyncio.run(process_batch_data(
+            input_file, output_file, BasicTaskDatum, noop_task_runner, get_quota_manager(),
+            input_reader=input_reader,
+        ))
+        assert sorted(row["task_id"] for row in read_output(output_file)) == [1, 2, 3, 4, 5]
+
+
+async def async_range(n):
+    for x in range(n):
+        yield {"x": x}
+
+
+@pytest.mark.parametrize("get_data_iterable", [
+    lambda: [{"x": x} for x in range(5)],
+    lambda: async_range(5),
+])
+def test_iterable_reader_reused(get_quota_manager, get_data_iterable):
+    input_reader = IterableInputReader(get_data_iterable())
+
+    async def main():
+        return [
+            task_datum.task_id
+            async for task_datum in iterate_batch_data(
+                input_reader, BasicTaskDatum, noop_task_runner, get_quota_manager(),
+            )
+        ]
+
+    for _ in range(2):
+        input_reader.data_iterable = get_data_iterable()
+        assert sorted(asyncio.run(main())) == [1, 2, 3, 4, 5]
+
+
+def read_all(input_reader, task_datum_class=BasicTaskDatum, buffer_size_list=None):
+    # task ids of everything the reader hands out, as the scheduler takes them
+    async def main():
+        wakeup_event = asyncio.Event()
+        input_reader.open(task_datum_class, wakeup_event)
+        task_id_list = []
+        try:
+            while not input_reader.is_done():
+                if buffer_size_list is not None:
+                    await asyncio.sleep(0.01)
+                    buffer_size_list.append(len(input_reader.buffer))
+                input_item = input_reader.get()
+                if input_item is None:
+                    if input_reader.is_done():
+                        break
+                    await asyncio.wait_for(wakeup_event.wait(), 5)
+                    wakeup_event.clear()
+                    continue
+                task_id_list.append(input_item[0])
+        finally:
+            input_reader.close()
+        return task_id_list
+    return asyncio.run(main())
+
+
+def test_reader_thread_buffer_is_bounded(tmp_path):
+    input_file = str(tmp_path / "in.jsonl")
+    write_input(input_file, range(30))
+    input_reader = InputReader(max_rows=4, batch_rows=2)
+    input_reader.set_input_file(input_file)
+    buffer_size_list = []
+    assert read_all(input_reader, buffer_size_list=buffer_size_list) == list(range(1, 31))
+    # the thread waits for space, a batch read meanwhile can top the buffer up past max_rows by less than a batch
+    assert max(buffer_size_list) <= 4 + 2 - 1
+    assert input_reader.get_progress() == 1
+
+
+@pytest.mark.parametrize("use_thread", [False, True])
+@pytest.mark.parametrize("use_input_index", [False, True])
+def test_reader_range_skips_completed(tmp_path, use_thread, use_input_index):
+    input_file = str(tmp_path / "in.jsonl")
+    write_input(input_file, range(20))
+    input_reader = InputReader(batch_rows=3, use_thread=use_thread)
+    input_reader.set_input_file(input_file, start_id=3, end_id=10, completed_task_id_set={5, 11},
+                                use_input_index=use_input_index)
+    assert read_all(input_reader) == [3, 4, 6, 7, 8, 9, 10]
+
+
+def test_reader_thread_error_fails_job(tmp_path, get_quota_manager):
+    class TaskDatum(BasicTaskDatum):
+        @classmethod
+        def prepare_data_list(cls, data_list):
+            if any(data["x"] == 7 for data in data_list):
+                raise ValueError("bad row")
+            return
+
+    input_file = str(tmp_path / "in.jsonl")
+    write_input(input_file, range(20))
+    with pytest.raises(ValueError):
+        asyncio.run(process_batch_data(
+            input_file, str(tmp_path / "out.jsonl"), TaskDatum, noop_task_runner, get_quota_manager(),
+            input_reader=InputReader(batch_rows=4),
+        ))
+
+
+def test_async_iterable_reader_waits_for_space():
+    produced_list = []
+
+    async def produce():
+        for x in range(40):
+            produced_list.append(x)
+            yield {"x": x}
+
+    input_reader = IterableInputReader(produce(), max_rows=8, batch_rows=4)
+    buffer_size_list = []
+    assert read_all(input_reader, buffer_size_list=buffer_size_list) == list(range(1, 41))
+    assert max(buffer_size_list) <= 8
+    assert len(produced_list) == 40
+
+
+def test_async_iterable_batches_are_prepared_off_loop():
+    thread_list = []
+
+    class TaskDatum(BasicTaskDatum):
+        @classmethod
+        def prepare_data_list(cls, data_list):
+            thread_list.append((len(data_list), threading.current_thread() is threading.main_thread()))
+            return
+
+    # full batches go to a worker thread, the rest is prepared on the loop once the iterable ends
+    input_reader = IterableInputReader(async_range(10), batch_rows=4)
+    assert read_all(input_reader, task_datum_class=TaskDatum) == list(range(1, 11))
+    assert thread_list == [(4, False), (4, False), (2, True)]
+
+
+def test_async_iterable_error_fails_job(get_quota_manager):
+    async def produce():
+        yield {"x": 0}
+        raise ValueError("source failed")
+
+    async def main():
+        async for _task_datum in iterate_batch_data(produce(), BasicTaskDatum, noop_task_runner, get_quota_manager()):
+            pass
+        return
+
+    with pytest.raises(ValueError):
+        asyncio.run(asyncio.wait_for(main(), 5))
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+
+import pytest
+
+import async_utils.async_utils
+from async_utils import (
+    process_batch_data, iterate_batch_data, BasicTaskDatum, FedGPTTaskDatum, FedGPTQuotaManager,
+    HTTPClient, ResponseCache,
+)
+
+
+async def noop_task_runner(task_datum):
+    return task_datum
+
+
+def test_resources_closed_when_input_is_missing(tmp_path, get_quota_manager):
+    event_list = []
+
+    class TaskDatum(BasicTaskDatum):
+        @classmethod
+        async def start_job(cls, completed_task_id_set):
+            event_list.append("start")
+            return
+
+        @classmethod
+        async def end_job(cls):
+            event_list.append("end")
+            return
+
+    response_cache = ResponseCache(str(tmp_path / "cache.db"))
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(process_batch_data(
+            str(tmp_path / "missing.jsonl"), str(tmp_path / "out.jsonl"), TaskDatum, noop_task_runner,
+            get_quota_manager(), response_cache=response_cache,
+        ))
+    assert event_list == ["start", "end"]
+    assert response_cache.connection is None
+
+
+def test_resources_not_closed_when_not_opened(tmp_path, get_quota_manager):
+    event_list = []
+
+    class TaskDatum(BasicTaskDatum):
+        @classmethod
+        async def start_job(cls, completed_task_id_set):
+            raise RuntimeError("start_job")
+
+        @classmethod
+        async def end_job(cls):
+            event_list.append("end")
+            return
+
+    async def main():
+        async for _task_datum in iterate_batch_data([{}], TaskDatum, noop_task_runner, get_quota_manager()):
+            pass
+        return
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main())
+    assert event_list == []
+
+
+def test_concurrent_jobs_share_http_client():
+    http_client = HTTPClient()
+    task_datum_class = type("TaskDatum", (FedGPTTaskDatum,), {"http_client": http_client})
+
+    async def task_runner(task_datum):
+        await asyncio.sleep(0.01 * task_datum.data["delay"])
+        assert not http_client.session.closed
+        return task_datum
+
+    async def run_job(delay):
+        async for task_datum in iterate_batch_data(
+            [{"text_in": "a", "model": "m", "delay": delay}] * 3, task_datum_class, task_runner,
+            FedGPTQuotaManager(10),
+        ):
+            assert not task_datum.run_failed
+        return
+
+    async def main():
+        await asyncio.gather(run_job(1), run_job(5))
+        assert http_client.session is None
+        return
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("level, created", [(logging.WARNING, False), (logging.INFO, True)])
+def test_progress_metrics_only_when_logged(monkeypatch, get_quota_manager, level, created):
+    created_list = []
+
+    class MetricsCollector(async_utils.async_utils.MetricsCollector):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created_list.append(self)
+            return
+
+    monkeypatch.setattr(async_utils.async_utils, "MetricsCollector", MetricsCollector)
+    logger = async_utils.async_utils.logger
+    logger_level = logger.level
+    logger.setLevel(level)
+
+    async def main():
+        async for _task_datum in iterate_batch_data(
+            [{}] * 3, BasicTaskDatum, noop_task_runner, get_quota_manager(), task_log_every=0,
+        ):
+            pass
+        return
+
+    try:
+        asyncio.run(main())
+    finally:
+        logger.setLevel(logger_level)
+    assert bool(created_list) == created
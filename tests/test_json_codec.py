@@ -0,0 +1,62 @@
+import json
+import math
+
+import pytest
+
+from async_utils import JSONCodec, RawJSON
+from async_utils.async_utils import split_json_fields
+
+BACKEND_LIST = ["json"]
+for module_name in ("orjson", "msgspec"):
+    try:
+        __import__(module_name)
+        BACKEND_LIST.append(module_name)
+    except ImportError:
+        pass
+
+LINE_LIST = [
+    b"{}",
+    b' { "a" : true ,"b":null } ',
+    b'{"a": 1, "b": -1.5e3, "c": "x\\"y\\\\", "d\\u00e9": [], "e": {}}',
+    '{"text": "文件內容", "meta": {"tags": [1, "é"]}, "list": [[1, 2], {"k": "文"}], "n": 0}'.encode("utf8"),
+    json.dumps(dict({f"a{i}": [i, "é"] for i in range(20)}, doc={"k": ["文" * 10] * 100}, tail="z")).encode("utf8"),
+]
+
+
+@pytest.mark.parametrize("line", LINE_LIST)
+def test_split_json_fields(line):
+    field_list = split_json_fields(line)
+    assert [key for key, _raw in field_list] == list(json.loads(line))
+    assert {key: json.loads(raw) for key, raw in field_list} == json.loads(line)
+
+
+@pytest.mark.parametrize("line", [b"", b"[]", b'{"a" 1}', b'{"a": }', b'{"a": "x}', b'{"a": [1, 2}', b'{"a": 1'])
+def test_split_json_fields_invalid(line):
+    with pytest.raises(ValueError):
+        split_json_fields(line)
+
+
+@pytest.mark.parametrize("backend", BACKEND_LIST)
+@pytest.mark.parametrize("line", LINE_LIST)
+def test_fields_roundtrip(backend, line):
+    codec = JSONCodec(backend)
+    data = codec.loads_fields(line, {"a", "meta"})
+    row = codec.dumps_object({"task_id": 1, "data": RawJSON(codec.dumps_object(data))})
+    assert json.loads(row) == {"task_id": 1, "data": json.loads(line)}
+
+
+@pytest.mark.parametrize("backend", BACKEND_LIST)
+def test_nan_falls_back(backend):
+    codec = JSONCodec(backend)
+    line = b'{"a": NaN, "b": "x"}'
+    assert math.isnan(codec.loads(line)["a"])
+    assert math.isnan(codec.loads_fields(line, {"a"})["a"])
+    assert codec.loads_fields(line, {"b"})["b"] == "x"
+
+
+@pytest.mark.parametrize("backend", BACKEND_LIST)
+def test_dumps_falls_back(backend):
+    codec = JSONCodec(backend)
+    assert json.loads(codec.dumps({"a": 2 ** 70})) == {"a": 2 ** 70}
+    with pytest.raises(TypeError):
+        codec.dumps({"a": object()})
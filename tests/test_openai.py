@@ -0,0 +1,35 @@
+import pytest
+
+from async_utils import OpenAITaskDatum
+
+
+class SplitTokenizer:
+    def encode(self, text):
+        return text.split()
+
+    def encode_batch(self, text_list, num_threads=8):
+        return [text.split() for text in text_list]
+
+
+@pytest.fixture
+def task_datum_class():
+    return type("TaskDatum", (OpenAITaskDatum,), {"tokenizer": SplitTokenizer()})
+
+
+@pytest.mark.parametrize("data_max_tokens, default_max_tokens, max_tokens", [
+    (None, None, None),
+    (None, 50, 50),
+    (20, 50, 20),
+])
+def test_reserved_max_tokens_are_requested(task_datum_class, data_max_tokens, default_max_tokens, max_tokens):
+    task_datum_class.default_max_tokens = default_max_tokens
+    data = {"text_in": "a b c d", "model": "m", "choices": 2}
+    if data_max_tokens is not None:
+        data["max_tokens"] = data_max_tokens
+    task_datum = task_datum_class(1, data)
+
+    assert task_datum.get_request_kwargs().get("max_completion_tokens") == max_tokens
+    if max_tokens is None:
+        assert task_datum.get_estimated_tokens() == 4 + 2 * 4
+    else:
+        assert task_datum.get_estimated_tokens() == 4 + 2 * max_tokens
@@ -0,0 +1,60 @@
+import json
+import asyncio
+
+import pytest
+
+from async_utils import process_batch_data, BasicTaskDatum, OutputWriter
+
+
+class FailingOutputWriter(OutputWriter):
+    # the first group commit fails, as with a full disk, and later ones succeed
+    failed = False
+
+    def commit(self, chunk, checkpoint_chunk):
+        if not self.failed:
+            self.failed = True
+            raise OSError("disk full")
+        return super().commit(chunk, checkpoint_chunk)
+
+
+async def slow_task_runner(task_datum):
+    # tasks finish after the latency timer, so the first commit runs from the timer
+    await asyncio.sleep(0.05 * task_datum.task_id)
+    return task_datum
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    input_file = str(tmp_path / "in.jsonl")
+    with open(input_file, "w", encoding="utf8") as f:
+        for x in range(3):
+            f.write(json.dumps({"x": x}) + "\n")
+    return input_file
+
+
+@pytest.mark.parametrize("use_thread", [False, True])
+def test_failed_commit_fails_job(tmp_path, input_file, get_quota_manager, use_thread):
+    output_writer = FailingOutputWriter(max_latency=0.01, use_thread=use_thread)
+    with pytest.raises(OSError):
+        asyncio.run(process_batch_data(
+            input_file, str(tmp_path / "out.jsonl"), BasicTaskDatum, slow_task_runner, get_quota_manager(),
+            output_writer=output_writer,
+        ))
+    assert output_writer.file.closed
+    assert output_writer.checkpoint_file is None
+    assert output_writer.executor is None
+
+
+def test_failed_final_flush_releases_file(tmp_path):
+    output_writer = FailingOutputWriter()
+    output_writer.open(str(tmp_path / "out.jsonl"), "w")
+
+    async def main():
+        output_writer.write_row(1, b"{}")
+        return
+
+    asyncio.run(main())
+    with pytest.raises(OSError):
+        output_writer.close()
+    assert output_writer.file.closed
+    assert output_writer.checkpoint_file is None
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+
+import pytest
+
+from async_utils import process_batch_data_in_processes, BasicTaskDatum, OpenAIQuotaManager
+from async_utils.async_utils import ProcessQuotaManager, get_shard_output_file
+
+
+async def double_task_runner(task_datum):
+    task_datum.data["result"] = 2 * task_datum.data["x"]
+    return task_datum
+
+
+@pytest.fixture
+def files(tmp_path):
+    input_file = str(tmp_path / "in.jsonl")
+    output_file = str(tmp_path / "out.jsonl")
+    with open(input_file, "w", encoding="utf8") as f:
+        for x in range(1, 41):
+            f.write(json.dumps({"x": x}) + "\n")
+    return input_file, output_file
+
+
+def read_output(output_file):
+    with open(output_file, encoding="utf8") as f:
+        return {row["task_id"]: row["data"] for row in map(json.loads, f)}
+
+
+def test_share_is_handed_over_after_window():
+    now = time.time()
+    finish_time_array = [0, 0, 0]
+    quota_manager = ProcessQuotaManager(OpenAIQuotaManager(90, 9000), finish_time_array)
+    assert quota_manager.quota_manager.rpm_limit == 30
+
+    # a worker that just finished keeps its share while its requests are in the window
+    finish_time_array[0] = now - 10
+    quota_manager.update_share()
+    assert quota_manager.quota_manager.rpm_limit == 30
+    assert quota_manager.next_update_time == now + 50
+    # with the share used up, the scheduler wakes up for the handover
+    quota_manager.quota_manager.rpm = 0
+    assert quota_manager.get_quota_available_time(BasicTaskDatum(1, {}), []) == now + 50
+
+    finish_time_array[0] = now - 61
+    quota_manager.update_share()
+    assert quota_manager.quota_manager.rpm_limit == 45
+    assert quota_manager.quota_manager.rpm == 15
+    assert quota_manager.next_update_time is None
+
+
+def test_shards_are_merged(files, get_quota_manager):
+    input_file, output_file = files
+    process_batch_data_in_processes(
+        input_file, output_file, BasicTaskDatum, double_task_runner, get_quota_manager(), processes=3,
+    )
+    task_id_to_data = read_output(output_file)
+    assert sorted(task_id_to_data) == list(range(1, 41))
+    assert all(data["result"] == 2 * data["x"] for data in task_id_to_data.values())
+    assert not [name for name in os.listdir(os.path.dirname(output_file)) if ".shard" in name]
+
+
+def test_resume_from_interrupted_shards(files, get_quota_manager):
+    input_file, output_file = files
+    # an interrupted run left rows in the merged output and in a shard output, one of them partly written
+    with open(output_file, "w", encoding="utf8") as f:
+        for task_id in range(1, 6):
+            f.write(json.dumps({"task_id": task_id, "data": {"x": task_id, "result": "old"}}) + "\n")
+    with open(get_shard_output_file(output_file, 1), "w", encoding="utf8") as f:
+        for task_id in range(21, 26):
+            f.write(json.dumps({"task_id": task_id, "data": {"x": task_id, "result": "old"}}) + "\n")
+        f.write('{"task_id": 26, "da')
+
+    process_batch_data_in_processes(
+        input_file, output_file, BasicTaskDatum, double_task_runner, get_quota_manager(), processes=2,
+    )
+    with open(output_file, encoding="utf8") as f:
+        task_id_list = [json.loads(line)["task_id"] for line in f]
+    assert sorted(task_id_list) == list(range(1, 41))
+    task_id_to_data = read_output(output_file)
+    old_task_id_list = [task_id for task_id, data in task_id_to_data.items() if data["result"] == "old"]
+    assert sorted(old_task_id_list) == [1, 2, 3, 4, 5, 21, 22, 23, 24, 25]
@@ -0,0 +1,146 @@
+import time
+import heapq
+import types
+
+import pytest
+
+from async_utils import OpenAIQuotaManager, OpenAIAdaptiveQuotaManager
+from async_utils.async_utils import QuotaRecord
+
+
+def get_task_datum(tokens):
+    return types.SimpleNamespace(get_estimated_tokens=lambda: tokens, get_used_tokens=lambda: None)
+
+
+def run(quota_manager, done_task_datum_queue, tokens, end_time):
+    # a run from deduction to the done heap, as iterate_batch_data does it
+    task_datum = get_task_datum(tokens)
+    quota_manager.deduct_quota(task_datum)
+    quota_manager.settle_quota(task_datum)
+    heapq.heappush(done_task_datum_queue, (end_time, len(done_task_datum_queue), QuotaRecord(task_datum)))
+    return
+
+
+def test_quota_available_time_walks_window():
+    quota_manager = OpenAIQuotaManager(10, 100)
+    done_task_datum_queue = []
+    now = time.time()
+    for k, tokens in enumerate([30, 30, 30]):
+        run(quota_manager, done_task_datum_queue, tokens, now - 30 + k)
+    assert quota_manager.window_requests == 3
+    assert quota_manager.window_tokens == 90
+
+    assert quota_manager.get_quota_available_time(get_task_datum(10), done_task_datum_queue) <= time.time()
+    assert quota_manager.get_quota_available_time(get_task_datum(40), done_task_datum_queue) == now + 30
+    assert quota_manager.get_quota_available_time(get_task_datum(70), done_task_datum_queue) == now + 31
+    # cached until the quota changes
+    assert quota_manager.get_quota_available_time(get_task_datum(70), done_task_datum_queue) == now + 31
+    quota_manager.deduct_quota(get_task_datum(5))
+    assert quota_manager.get_quota_available_time(get_task_datum(70), done_task_datum_queue) == now + 32
+
+    # the running task holds tokens that the window cannot give back
+    assert quota_manager.get_quota_available_time(get_task_datum(100), done_task_datum_queue) is None
+
+
+def test_reclaim_updates_window_and_cache():
+    quota_manager = OpenAIQuotaManager(2, 1000)
+    done_task_datum_queue = []
+    now = time.time()
+    run(quota_manager, done_task_datum_queue, 10, now - 61)
+    run(quota_manager, done_task_datum_queue, 10, now - 20)
+    # the first run has expired but is not reclaimed yet
+    assert quota_manager.get_quota_available_time(get_task_datum(10), done_task_datum_queue) == now - 1
+
+    quota_manager.reclaim_quota(done_task_datum_queue)
+    assert (quota_manager.window_requests, quota_manager.window_tokens) == (1, 10)
+    assert quota_manager.get_quota_available_time(get_task_datum(10), done_task_datum_queue) <= time.time()
+    run(quota_manager, done_task_datum_queue, 10, now)
+    assert quota_manager.get_quota_available_time(get_task_datum(10), done_task_datum_queue) == now + 40
+
+
+def settle_headers(quota_manager, headers):
+    task_datum = get_task_datum(10)
+    quota_manager.deduct_quota(task_datum)
+    task_datum.end_time = time.time()
+    task_datum.response_headers = headers
+    quota_manager.settle_quota(task_datum)
+    return
+
+
+@pytest.mark.parametrize("value", ["", "n/a", "1e999", None])
+def test_adaptive_ignores_malformed_headers(value):
+    quota_manager = OpenAIAdaptiveQuotaManager(100, 1000)
+    settle_headers(quota_manager, {
+        "x-ratelimit-limit-requests": value,
+        "x-ratelimit-limit-tokens": value,
+        "x-ratelimit-remaining-requests": value,
+        "x-ratelimit-remaining-tokens": value,
+        "x-ratelimit-reset-requests": value,
+    })
+    assert (quota_manager.rpm_limit, quota_manager.tpm_limit) == (100, 1000)
+    assert quota_manager.header_requests is None
+    assert quota_manager.header_tokens is None
+
+
+def test_adaptive_parses_numeric_headers():
+    quota_manager = OpenAIAdaptiveQuotaManager(100, 1000)
+    settle_headers(quota_manager, {
+        "x-ratelimit-limit-requests": "50.0",
+        "x-ratelimit-remaining-requests": "40",
+        "x-ratelimit-reset-requests": "30",
+        "x-ratelimit-remaining-tokens": "500",
+        "x-ratelimit-reset-tokens": "1m0.5s",
+    })
+    assert quota_manager.rpm_limit == 50
+    assert quota_manager.header_requests == 40
+    assert quota_manager.header_tokens == 500
+    assert quota_manager.header_tokens_reset_time - quota_manager.header_requests_reset_time == pytest.approx(30.5)
+
+
+def test_adaptive_counts_runs_sent_after_the_response():
+    quota_manager = OpenAIAdaptiveQuotaManager(100, 10000)
+    now = time.time()
+    task_datum_list = [get_task_datum(10) for _ in range(3)]
+    for task_datum in task_datum_list:
+        quota_manager.deduct_quota(task_datum)
+
+    # the provider counted the first run only, the two runs sent after it are taken off its remaining budget
+    task_datum_list[0].end_time = now
+    task_datum_list[0].response_headers = {
+        "x-ratelimit-remaining-requests": "5", "x-ratelimit-remaining-tokens": "100",
+        "x-ratelimit-reset-requests": "10s", "x-ratelimit-reset-tokens": "20s",
+    }
+    quota_manager.settle_quota(task_datum_list[0])
+    assert quota_manager.header_requests == 3
+    assert quota_manager.header_tokens == 80
+
+    # a response that ended earlier is stale
+    task_datum_list[1].end_time = now - 1
+    task_datum_list[1].response_headers = {"x-ratelimit-remaining-requests": "50"}
+    quota_manager.settle_quota(task_datum_list[1])
+    assert quota_manager.header_requests == 3
+
+    # runs sent from now on come off the header budget too
+    quota_manager.deduct_quota(get_task_datum(30))
+    assert (quota_manager.header_requests, quota_manager.header_tokens) == (2, 50)
+
+
+def test_adaptive_waits_for_header_reset():
+    quota_manager = OpenAIAdaptiveQuotaManager(100, 10000)
+    now = time.time()
+    task_datum = get_task_datum(10)
+    quota_manager.deduct_quota(task_datum)
+    task_datum.end_time = now
+    task_datum.response_headers = {
+        "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s",
+        "x-ratelimit-remaining-tokens": "5000", "x-ratelimit-reset-tokens": "1s",
+    }
+    quota_manager.settle_quota(task_datum)
+
+    # the local window has quota, the provider reports none left until the reset
+    init_task_datum = get_task_datum(10)
+    assert quota_manager.rpm > 0
+    assert not quota_manager.has_enough_quota(init_task_datum)
+    assert quota_manager.get_quota_available_time(init_task_datum, []) == pytest.approx(now + 2)
+    quota_manager.header_requests_reset_time = time.time() - 1
+    assert quota_manager.has_enough_quota(init_task_datum)
@@ -0,0 +1,65 @@
+import sqlite3
+
+from async_utils import ResponseCache
+
+
+def test_put_and_get(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    cache.open()
+    key = cache.get_key({"text_in": "a"})
+    assert cache.get(key) is None
+    cache.put(key, {"text_out_list": ["b"]})
+    assert cache.get(key) == {"text_out_list": ["b"]}
+    cache.close()
+
+    cache.open()
+    assert cache.get(key) == {"text_out_list": ["b"]}
+    cache.close()
+
+
+def test_shared_file(tmp_path):
+    # two processes or jobs writing one cache file, neither holds the write lock between commits
+    cache_file = str(tmp_path / "cache.db")
+    cache_a = ResponseCache(cache_file, max_pending_writes=3, timeout=0.1)
+    cache_b = ResponseCache(cache_file, max_pending_writes=3, timeout=0.1)
+    cache_a.open()
+    cache_b.open()
+    for i in range(10):
+        cache_a.put(cache_a.get_key(["a", i]), i)
+        cache_b.put(cache_b.get_key(["b", i]), i)
+        cache_b.get(cache_b.get_key(["a", 0]))
+    cache_a.close()
+    cache_b.close()
+
+    connection = sqlite3.connect(cache_file)
+    assert connection.execute("SELECT COUNT(*) FROM response").fetchone()[0] == 20
+    connection.close()
+
+
+def test_evict(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_bytes=2000, max_pending_writes=1)
+    cache.open()
+    key_list = [cache.get_key(i) for i in range(40)]
+    for key in key_list:
+        cache.put(key, "x" * 100)
+    assert cache.evictions > 0
+    assert cache.total_bytes <= 2000
+    assert cache.get(key_list[-1]) == "x" * 100
+    assert cache.get(key_list[0]) is None
+    cache.close()
+
+
+def test_read_only(tmp_path):
+    cache_file = str(tmp_path / "cache.db")
+    cache = ResponseCache(cache_file)
+    cache.open()
+    key = cache.get_key("a")
+    cache.put(key, 1)
+    cache.close()
+
+    cache = ResponseCache(cache_file, mode="read_only")
+    cache.open()
+    cache.put(cache.get_key("b"), 2)
+    assert cache.get(key) == 1
+    assert cache.get(cache.get_key("b")) is None
+    cache.close()
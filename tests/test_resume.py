@@ -0,0 +1,160 @@
+import os
+import json
+import asyncio
+
+import pytest
+
+from async_utils import process_batch_data, BasicTaskDatum, OutputWriter
+from async_utils.async_utils import (
+    load_completed_task_id_set, read_checkpoint, get_checkpoint_file, truncate_partial_line, CHECKPOINT_RECORD,
+)
+
+
+async def double_task_runner(task_datum):
+    task_datum.data["result"] = 2 * task_datum.data["x"]
+    return task_datum
+
+
+@pytest.fixture
+def run(get_quota_manager):
+    def run(input_file, output_file, **kwargs):
+        asyncio.run(process_batch_data(
+            input_file, output_file, BasicTaskDatum, double_task_runner, get_quota_manager(), **kwargs,
+        ))
+        return
+    return run
+
+
+def read_output(output_file):
+    with open(output_file, encoding="utf8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def files(tmp_path):
+    input_file = str(tmp_path / "in.jsonl")
+    output_file = str(tmp_path / "out.jsonl")
+    with open(input_file, "w", encoding="utf8") as f:
+        for x in range(10):
+            f.write(json.dumps({"x": x}) + "\n")
+    return input_file, output_file
+
+
+def assert_complete(output_file, task_id_list=range(1, 11)):
+    row_list = read_output(output_file)
+    assert sorted(row["task_id"] for row in row_list) == list(task_id_list)
+    for row in row_list:
+        assert row["data"]["result"] == 2 * (row["task_id"] - 1)
+    assert load_completed_task_id_set(output_file) == set(task_id_list)
+    return
+
+
+def test_resume_runs_only_missing_tasks(files, run):
+    input_file, output_file = files
+    run(input_file, output_file, end_id=4)
+    assert_complete(output_file, range(1, 5))
+    run(input_file, output_file)
+    assert_complete(output_file)
+    run(input_file, output_file)
+    assert_complete(output_file)
+
+
+def test_checkpoint_matches_output(files, run):
+    input_file, output_file = files
+    run(input_file, output_file)
+    task_id_array, offset_array = read_checkpoint(get_checkpoint_file(output_file), output_file)
+    assert sorted(task_id_array) == list(range(1, 11))
+    assert offset_array[-1] == os.path.getsize(output_file)
+
+
+def test_rewrite_ignores_existing_output(files, run):
+    input_file, output_file = files
+    run(input_file, output_file)
+    run(input_file, output_file, end_id=3, ignore_and_rewrite_output_file=True)
+    assert_complete(output_file, range(1, 4))
+
+
+def test_deleted_output_with_stale_checkpoint(files, run):
+    input_file, output_file = files
+    run(input_file, output_file)
+    os.remove(output_file)
+    run(input_file, output_file, end_id=3)
+    assert_complete(output_file, range(1, 4))
+    run(input_file, output_file)
+    assert_complete(output_file)
+
+
+def test_checkpoint_of_other_rows_is_rejected(files, run):
+    input_file, output_file = files
+    run(input_file, output_file)
+    checkpoint_file = get_checkpoint_file(output_file)
+    with open(checkpoint_file, "rb") as f:
+        checkpoint_bytes = f.read()
+
+    # the sidecar of a previous output file, with this file's last row appended
+    os.remove(output_file)
+    run(input_file, output_file, end_id=1)
+    with open(output_file, "rb") as f:
+        row_bytes = f.read()
+    with open(checkpoint_file, "wb") as f:
+        f.write(checkpoint_bytes + CHECKPOINT_RECORD.pack(1, len(row_bytes)))
+    assert read_checkpoint(checkpoint_file, output_file) is None
+    assert load_completed_task_id_set(output_file) == {1}
+
+
+def test_checkpoint_behind_output(files, run):
+    input_file, output_file = files
+    run(input_file, output_file)
+    checkpoint_file = get_checkpoint_file(output_file)
+    with open(checkpoint_file, "rb+") as f:
+        f.truncate(3 * CHECKPOINT_RECORD.size)
+    assert load_completed_task_id_set(output_file) == set(range(1, 11))
+    assert os.path.getsize(checkpoint_file) == 10 * CHECKPOINT_RECORD.size
+
+
+def test_checkpoint_ahead_of_output(files, run):
+    input_file, output_file = files
+    run(input_file, output_file)
+    with open(output_file, "rb") as f:
+        line_list = f.readlines()
+    with open(output_file, "wb") as f:
+        f.writelines(line_list[:6])
+    completed_task_id_set = {json.loads(line)["task_id"] for line in line_list[:6]}
+    assert load_completed_task_id_set(output_file) == completed_task_id_set
+    run(input_file, output_file)
+    assert_complete(output_file)
+
+
+def test_missing_checkpoint(files, run):
+    input_file, output_file = files
+    run(input_file, output_file, end_id=5)
+    os.remove(get_checkpoint_file(output_file))
+    run(input_file, output_file)
+    assert_complete(output_file)
+
+
+def test_truncate_partial_line(tmp_path):
+    file = str(tmp_path / "out.jsonl")
+    with open(file, "wb") as f:
+        f.write(b'{"task_id": 1}\n{"task_id": 2}\n{"task_id": 3, "da')
+    assert truncate_partial_line(file) == len(b'{"task_id": 3, "da')
+    with open(file, "rb") as f:
+        assert f.read() == b'{"task_id": 1}\n{"task_id": 2}\n'
+    assert truncate_partial_line(file) == 0
+
+
+def test_resume_after_partial_line(files, run):
+    input_file, output_file = files
+    run(input_file, output_file, end_id=5)
+    with open(output_file, "ab") as f:
+        f.write(b'{"task_id": 6, "data": {"x"')
+    run(input_file, output_file)
+    assert_complete(output_file)
+
+
+def test_checkpoint_disabled_removes_sidecar(files, run):
+    input_file, output_file = files
+    run(input_file, output_file, end_id=5)
+    run(input_file, output_file, output_writer=OutputWriter(checkpoint=False))
+    assert not os.path.exists(get_checkpoint_file(output_file))
+    assert_complete(output_file)
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from async_utils import iterate_batch_data, BasicTaskDatum, RetryPolicy
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def run(quota_manager, status_code_list, max_task_runs, retry_policy):
+    # a single task whose runs fail with status_code_list in order, then succeed
+    status_code_iterator = iter(status_code_list)
+
+    async def task_runner(task_datum):
+        status_code = next(status_code_iterator, None)
+        if status_code is not None:
+            raise StatusError(status_code)
+        return task_datum
+
+    async def main():
+        return [
+            task_datum
+            async for task_datum in iterate_batch_data(
+                [{}], BasicTaskDatum, task_runner, quota_manager,
+                max_task_runs=max_task_runs, retry_policy=retry_policy,
+            )
+        ]
+    task_datum_list = asyncio.run(asyncio.wait_for(main(), 10))
+    assert len(task_datum_list) == 1
+    return task_datum_list[0]
+
+
+@pytest.mark.parametrize("status_code_list, max_task_runs, run_failed, runs", [
+    ([], 1, False, 1),
+    ([500], 1, True, 1),
+    ([500], 2, False, 2),
+    ([400], 3, True, 1),
+    ([429, 429, 500], 1, True, 3),
+    ([429] * 5, 1, False, 6),
+    ([429] * 50, 1, True, 10),
+])
+def test_retry(get_quota_manager, status_code_list, max_task_runs, run_failed, runs):
+    retry_policy = RetryPolicy(base_delay=0, max_throttled_runs=10)
+    task_datum = run(get_quota_manager(), status_code_list, max_task_runs, retry_policy)
+    assert task_datum.run_failed == run_failed
+    assert task_datum.run_id == runs
@@ -0,0 +1,105 @@
+import time
+import asyncio
+
+from async_utils import iterate_batch_data, BasicTaskDatum, RetryPolicy
+
+
+class ConcurrencyQuotaManager:
+    # one run at a time, the quota comes back when the run settles, so only a completion can free it
+    uses_done_queue = False
+
+    def __init__(self):
+        self.running = 0
+        self.quota_time_calls = 0
+        return
+
+    def has_enough_quota(self, init_task_datum):
+        return self.running == 0
+
+    def reclaim_quota(self, done_task_datum_queue):
+        return
+
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        self.quota_time_calls += 1
+        return None
+
+    def deduct_quota(self, init_task_datum):
+        self.running += 1
+        return
+
+    def settle_quota(self, done_task_datum):
+        self.running -= 1
+        return
+
+    def get_headroom(self):
+        return 1 - self.running
+
+
+class ScheduledQuotaManager(ConcurrencyQuotaManager):
+    # no quota until a known time
+    def __init__(self, quota_time):
+        super().__init__()
+        self.quota_time = quota_time
+        return
+
+    def has_enough_quota(self, init_task_datum):
+        return time.time() >= self.quota_time
+
+    def get_quota_available_time(self, init_task_datum, done_task_datum_queue):
+        self.quota_time_calls += 1
+        return self.quota_time
+
+
+def run(task_runner, quota_manager, tasks, **kwargs):
+    async def main():
+        return [
+            task_datum
+            async for task_datum in iterate_batch_data(
+                [{}] * tasks, BasicTaskDatum, task_runner, quota_manager, sleep_interval=10, **kwargs,
+            )
+        ]
+    return asyncio.run(asyncio.wait_for(main(), 5))
+
+
+def test_completion_wakes_scheduler():
+    async def task_runner(task_datum):
+        await asyncio.sleep(0.01)
+        return task_datum
+
+    quota_manager = ConcurrencyQuotaManager()
+    start_time = time.time()
+    assert len(run(task_runner, quota_manager, 10)) == 10
+    # each run starts when the previous one completes, not after a 10-second poll
+    assert time.time() - start_time < 1
+    # about one wakeup per completion, the scheduler does not spin while runs hold the quota
+    assert quota_manager.quota_time_calls <= 2 * 10
+
+
+def test_quota_deadline_wakes_scheduler():
+    start_time_list = []
+
+    async def task_runner(task_datum):
+        start_time_list.append(time.time())
+        return task_datum
+
+    quota_time = time.time() + 0.2
+    quota_manager = ScheduledQuotaManager(quota_time)
+    assert len(run(task_runner, quota_manager, 3)) == 3
+    assert quota_time <= min(start_time_list) < quota_time + 0.15
+    # the scheduler sleeps until the deadline rather than polling for it
+    assert quota_manager.quota_time_calls <= 3
+
+
+def test_retry_deadline_wakes_scheduler():
+    start_time_list = []
+
+    async def task_runner(task_datum):
+        start_time_list.append(time.time())
+        if len(start_time_list) == 1:
+            raise RuntimeError("transient")
+        return task_datum
+
+    retry_policy = RetryPolicy(base_delay=0.2, jitter=0)
+    task_datum_list = run(task_runner, ConcurrencyQuotaManager(), 1, max_task_runs=2, retry_policy=retry_policy)
+    assert not task_datum_list[0].run_failed
+    assert 0.2 <= start_time_list[1] - start_time_list[0] < 0.35